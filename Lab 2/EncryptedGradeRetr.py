@@ -10,37 +10,1189 @@
 # Imports 
 ########################################################################
 
+import time
+# Taken before anything else is imported so that the startup time
+# reported by the server and client covers the module imports.
+PROCESS_START_TIME = time.perf_counter()
+
 import argparse
+import base64
+import bisect
+import contextlib
+import hashlib
+import importlib
+import importlib.util
+import itertools
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import signal
 import socket
+import struct
 import sys
-from cryptography.fernet import Fernet
+import threading
+from array import array
+from collections import OrderedDict, namedtuple
 import csv
-import pandas as pd
+
 ########################################################################
-# Echo Server class
+# Lazy imports
+########################################################################
+
+class LazyModule:
+
+    # Stand-in for a heavy module that is only imported the first time
+    # one of its attributes is used. A client that just looks up one
+    # key and decrypts one reply never pays for importing pandas or
+    # numpy, and asyncio is only loaded by the asyncio server mode.
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attr)
+
+log = logging.getLogger("grade_server")
+
+asyncio = LazyModule("asyncio")
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+
+def pandas_available():
+    return importlib.util.find_spec("pandas") is not None
+
+def startup_time_ms():
+    return (time.perf_counter() - PROCESS_START_TIME) * 1000
+
 ########################################################################
+# Fernet cipher cache
+########################################################################
+
+class CipherCache:
+
+    # Building a Fernet object parses and validates the base64 key
+    # every time. The cache keeps ready-to-use Fernet objects for the
+    # most recently used keys, evicting the least recently used one
+    # once maxsize keys are held.
+
+    MAXSIZE = 4096
+
+    def __init__(self, maxsize=MAXSIZE):
+        self.maxsize = maxsize
+        self.ciphers = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, store=True):
+        # With store=False a missing cipher is built but not cached,
+        # so one-off scans (such as a roster export) do not push the
+        # hot keys out of the cache.
+        with self.lock:
+            fernet = self.ciphers.get(key)
+            if fernet is not None:
+                self.ciphers.move_to_end(key)
+                self.hits += 1
+                return fernet
+            self.misses += 1
+
+        # Build the cipher outside of the lock.
+        from cryptography.fernet import Fernet
+        fernet = Fernet(key.encode('utf-8'))
+        if not store:
+            return fernet
 
-def encrypt(message, key):
-    # encode both the message and the key to bytes
+        with self.lock:
+            self.ciphers[key] = fernet
+            self.ciphers.move_to_end(key)
+            if len(self.ciphers) > self.maxsize:
+                self.ciphers.popitem(last=False)
+                self.evictions += 1
+        return fernet
+
+    def stats(self):
+        return {"size": len(self.ciphers), "maxsize": self.maxsize,
+                "hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions}
+
+# Shared by the server and client.
+cipher_cache = CipherCache()
+
+def encrypt(message, key, cache=True):
+    # encode the message to bytes
     message_bytes = message.encode('utf-8')
-    encryption_key_bytes = key.encode('utf-8')
-    # use fernet to encrypt the message with the key
-    fernet = Fernet(encryption_key_bytes)
+    # get the fernet object for this key
+    fernet = cipher_cache.get(key, store=cache)
     #encrypt the message
     encrypted_message_bytes = fernet.encrypt(message_bytes)
     return encrypted_message_bytes
 
 def decypt(encrypted_message_bytes, key):
-    #encode the key to bytes
-    encryption_key_bytes = key.encode('utf-8')
+    # get the fernet object for this key
+    fernet = cipher_cache.get(key)
     # use fernet to decrypt the message with the key
-    fernet = Fernet(encryption_key_bytes)
     decrypted_message_bytes = fernet.decrypt(encrypted_message_bytes)
     #decode the message
     decrypted_message = decrypted_message_bytes.decode('utf-8')
     return decrypted_message
 
+########################################################################
+# Framed protocol
+########################################################################
+
+# Protocol version 2 wraps every message in a frame: a 4 byte
+# big-endian length field followed by the payload.
+#
+# -----------------------------------------
+# | 4 byte payload length | ... payload ... |
+# -----------------------------------------
+#
+# A framed request payload is "student_id,CMD1+CMD2+..." and the
+# response payload is a single Fernet token holding one "CMD=result"
+# line per command. Frames let a client pipeline many requests on one
+# connection. Frames are limited to MAX_FRAME_SIZE, so the first byte
+# of a framed connection is always 0x00. That can never start a legacy
+# "student_id,command" request, which is how the server tells the two
+# versions apart.
+
+FRAME_LENGTH_FIELD_LEN = 4
+MAX_FRAME_SIZE = 1 << 24
+FRAMED_PROTOCOL_MARKER = b'\x00'
+BATCH_SEPARATOR = "+"
+
+# Requests may name a course before the student ID, e.g.
+# "coe4dn4,1803933,GG". Requests without one use the default course,
+# which is the grades file given to the server.
+DEFAULT_COURSE = ""
+COURSE_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}$")
+
+def encode_frame(payload):
+    return len(payload).to_bytes(FRAME_LENGTH_FIELD_LEN, byteorder='big') + payload
+
+def recv_exact(sock, bytecount_target):
+    # Keep calling recv until bytecount_target bytes have arrived.
+    # Returns None if the other end closes first.
+    recvd = bytearray()
+    while len(recvd) < bytecount_target:
+        new_bytes = sock.recv(bytecount_target - len(recvd))
+        if not new_bytes:
+            return None
+        recvd += new_bytes
+    return bytes(recvd)
+
+def recv_frame(sock):
+    # Return the next frame payload, or None if the connection closed
+    # or the length field is out of range.
+    length_field = recv_exact(sock, FRAME_LENGTH_FIELD_LEN)
+    if length_field is None:
+        return None
+    length = int.from_bytes(length_field, byteorder='big')
+    if length > MAX_FRAME_SIZE:
+        return None
+    return recv_exact(sock, length)
+
+def parse_batch_response(message):
+    # Turn a decrypted "CMD=result" response into a dict.
+    results = {}
+    for line in message.splitlines():
+        command_id, _, result = line.partition('=')
+        results[command_id] = result
+    return results
+
+########################################################################
+# Session keys
+########################################################################
+
+# A framed client can open a session instead of getting a Fernet token
+# per reply. It sends "SESSION,[course,]student_id,client_nonce" (16
+# byte nonce in hex). The server answers with its own 16 byte nonce followed by
+# the sealed confirmation "OK". Both ends then derive a per-connection
+# AES-GCM key from the student's key with HKDF-SHA256, using the two
+# nonces as salt. From then on every frame in either direction is
+# just AES-GCM ciphertext plus its 16 byte tag:
+#
+#   request plaintext:  "CMD1+CMD2+..."
+#   response plaintext: "CMD1=result\nCMD2=result..." (or "0")
+#
+# Nonces are a 4 byte direction label and an 8 byte message counter
+# that both ends keep implicitly, so frames carry no IV and a replayed
+# or reordered frame fails authentication.
+
+SESSION_COMMAND = "SESSION"
+SESSION_NONCE_LEN = 16
+SESSION_CONFIRMATION = b'OK'
+SESSION_KDF_INFO = b'coe4dn4 grade session v1'
+SESSION_CLIENT_LABEL = b'C2S\x00'
+SESSION_SERVER_LABEL = b'S2C\x00'
+
+class GradeSession:
+
+    def __init__(self, student_id, key, client_nonce, server_nonce, is_server,
+                 course=DEFAULT_COURSE):
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+        self.student_id = student_id
+        self.course = course
+        session_key = HKDF(algorithm=hashes.SHA256(), length=32,
+                           salt=client_nonce + server_nonce,
+                           info=SESSION_KDF_INFO).derive(base64.urlsafe_b64decode(key))
+        self.aead = AESGCM(session_key)
+        if is_server:
+            self.send_label, self.recv_label = SESSION_SERVER_LABEL, SESSION_CLIENT_LABEL
+        else:
+            self.send_label, self.recv_label = SESSION_CLIENT_LABEL, SESSION_SERVER_LABEL
+        self.send_counter = 0
+        self.recv_counter = 0
+
+    def seal(self, plaintext):
+        nonce = self.send_label + self.send_counter.to_bytes(8, byteorder='big')
+        self.send_counter += 1
+        return self.aead.encrypt(nonce, plaintext, None)
+
+    def open(self, ciphertext):
+        # Raises cryptography.exceptions.InvalidTag if the frame was
+        # tampered with, replayed or reordered.
+        nonce = self.recv_label + self.recv_counter.to_bytes(8, byteorder='big')
+        plaintext = self.aead.decrypt(nonce, ciphertext, None)
+        self.recv_counter += 1
+        return plaintext
+
+########################################################################
+# Grade roster
+########################################################################
+
+# Grade columns are numbered from the first assessment (Lab 1) in the
+# CSV. Each column code names one or more of them. Codes that span
+# several columns (the exams) score a student by their mean.
+GRADE_COLUMN_CODES = {
+    "L1": [0],         # lab 1 (col 4)
+    "L2": [1],         # lab 2 (col 5)
+    "L3": [2],         # lab 3 (col 6)
+    "L4": [3],         # lab 4 (col 7)
+    "M":  [4],         # midterm (col 8)
+    "E":  [5, 6, 7, 8] # exams (col 9-12)
+}
+
+# Column code averaged by each of the class average commands.
+AVERAGE_COMMANDS = {
+    "GL1A": "L1",
+    "GL2A": "L2",
+    "GL3A": "L3",
+    "GL4A": "L4",
+    "GMA":  "M",
+    "GEA":  "E"
+}
+
+# Statistics commands take the form "STAT:CODE[:ARG]", e.g. "MED:M",
+# "PCT:E:90", "HIST:L1:5" or "RANK:M". They are computed with
+# vectorized numpy operations over a whole column.
+#
+# The bin count of HIST comes from the client, so it is bounded. A
+# histogram does not fit in the single RECV_BUFFER_SIZE read of a
+# legacy client, so HIST is only answered on framed connections.
+STATS_COMMANDS = ("MED", "STD", "PCT", "HIST", "RANK")
+STATS_SEPARATOR = ":"
+HISTOGRAM_COMMAND = "HIST"
+HISTOGRAM_BINS = 10
+MAX_HISTOGRAM_BINS = 100
+
+# Names of the individual grade columns, as used by the update command.
+GRADE_COLUMN_NAMES = ("L1", "L2", "L3", "L4", "M", "E1", "E2", "E3", "E4")
+
+# One student's entry in the roster.
+StudentRecord = namedtuple("StudentRecord", ["row", "student_id", "key", "grades"])
+
+def format_grades(grades):
+    # Show whole number grades without a trailing ".0".
+    return [int(grade) if float(grade).is_integer() else float(grade) for grade in grades]
+
+class GradeAggregates:
+
+    # Running per-column sums over the whole class. These are computed
+    # once when the roster is loaded, so the average commands are O(1)
+    # no matter how many students there are. When a grade changes only
+    # the difference is applied to the running sum.
+
+    def __init__(self, count, sums):
+        self.count = count
+        self.sums = sums
+
+    def average(self, command_id):
+        columns = GRADE_COLUMN_CODES[AVERAGE_COMMANDS[command_id]]
+        num_grades = self.count * len(columns)
+        if num_grades == 0:
+            return 0.0
+        return float(sum(self.sums[column] for column in columns)) / num_grades
+
+    def update(self, column, old_grade, new_grade):
+        self.sums[column] += float(new_grade) - float(old_grade)
+
+class GradeRoster:
+
+    # The roster is read from the course CSV once and then kept in
+    # memory as columns: a numpy array of student IDs, a list of keys
+    # and a 2-D numpy array of grades (one row per student, one column
+    # per assessment). A dict maps each student ID to its row so that
+    # a lookup is a single hash probe. The file is read in chunks of
+    # CHUNK_ROWS rows that are appended to the columns as they are
+    # parsed, so a load never holds more than one chunk of parsed CSV
+    # on top of the roster itself. When the CSV changes a new
+    # GradeRoster is built and swapped in by the RosterWatcher. Grade
+    # updates are the only in-place changes; they go through the
+    # roster's GradeJournal so that they survive a restart.
+
+    # Column positions within the CSV.
+    ID_COLUMN = 1
+    KEY_COLUMN = 2
+    FIRST_GRADE_COLUMN = 3
+    NUM_GRADE_COLUMNS = 9
+
+    CHUNK_ROWS = 1 << 16
+
+    # ShardSpec when this process serves one shard of the roster.
+    SHARD = None
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.load()
+
+    # CSV parser: "pandas", "csv", or "auto" to use pandas when it is
+    # installed and fall back to the csv module otherwise.
+    PARSER = "auto"
+
+    def load(self):
+        start_time = time.perf_counter()
+        self.mtime = os.path.getmtime(self.filename)
+        parser = GradeRoster.PARSER
+        if parser == "auto":
+            parser = "pandas" if pandas_available() else "csv"
+        chunks = self.read_chunks_pandas() if parser == "pandas" else self.read_chunks_csv()
+
+        # The ID and grade columns grow in arrays and are viewed by
+        # numpy without copying once the whole file has been read.
+        ids = array('q')
+        grades = array('d')
+        self.keys = []
+        # student id -> row
+        self.index = {}
+        sums = np.zeros(GradeRoster.NUM_GRADE_COLUMNS)
+        for chunk_ids, chunk_keys, chunk_grades in chunks:
+            if GradeRoster.SHARD is not None:
+                # Keep only the students that belong to this shard.
+                keep = shard_of_ids(chunk_ids, GradeRoster.SHARD) == GradeRoster.SHARD.index
+                chunk_ids, chunk_grades = chunk_ids[keep], chunk_grades[keep]
+                chunk_keys = list(itertools.compress(chunk_keys, keep))
+            self.index.update(zip(chunk_ids.tolist(), range(len(ids), len(ids) + len(chunk_ids))))
+            ids.frombytes(chunk_ids.tobytes())
+            grades.frombytes(chunk_grades.tobytes())
+            self.keys.extend(chunk_keys)
+            sums += chunk_grades.sum(axis=0)
+        self.ids = np.frombuffer(ids, dtype=np.int64) if ids else np.zeros(0, dtype=np.int64)
+        self.grades = np.frombuffer(grades, dtype=np.float64) if grades else np.zeros(0)
+        self.grades.shape = (len(self.ids), GradeRoster.NUM_GRADE_COLUMNS)
+        self.aggregates = GradeAggregates(len(self.ids), sums)
+
+        elapsed = time.perf_counter() - start_time
+        log.info("Loaded %s students from %s in %.1f ms (%.0f rows/s), index %.1f MB",
+                 len(self), self.filename, elapsed * 1000, len(self) / elapsed if elapsed > 0 else 0,
+                 self.memory_usage() / (1024 * 1024))
+
+        # Apply the updates that have not been compacted into the CSV.
+        self.journal = GradeJournal(self.filename)
+        self.journal.replay(self)
+
+    def read_chunks_pandas(self):
+        # Generate (ids, keys, grades) for every CHUNK_ROWS rows.
+        first = GradeRoster.FIRST_GRADE_COLUMN
+        self.header = None
+        for df in pd.read_csv(self.filename, chunksize=GradeRoster.CHUNK_ROWS):
+            if self.header is None:
+                self.header = list(df.columns)
+            yield (df.iloc[:, GradeRoster.ID_COLUMN].to_numpy(dtype=np.int64),
+                   df.iloc[:, GradeRoster.KEY_COLUMN].astype(str).tolist(),
+                   df.iloc[:, first:first + GradeRoster.NUM_GRADE_COLUMNS].to_numpy(dtype=np.float64))
+
+    def read_chunks_csv(self):
+        first = GradeRoster.FIRST_GRADE_COLUMN
+        last = first + GradeRoster.NUM_GRADE_COLUMNS
+        with open(self.filename, newline='') as file:
+            reader = csv.reader(file)
+            self.header = next(reader)
+            while True:
+                rows = list(itertools.islice(reader, GradeRoster.CHUNK_ROWS))
+                if not rows:
+                    return
+                grades = array('d', (float(grade) for row in rows for grade in row[first:last]))
+                yield (np.array([int(row[GradeRoster.ID_COLUMN]) for row in rows], dtype=np.int64),
+                       [row[GradeRoster.KEY_COLUMN] for row in rows],
+                       np.frombuffer(grades, dtype=np.float64).reshape(len(rows), -1))
+
+    def lookup(self, student_id):
+        # Return the StudentRecord for the given student ID, or None
+        # if the student is not in the roster.
+        try:
+            row = self.index.get(int(student_id))
+        except ValueError:
+            return None
+        if row is None:
+            return None
+        return self.record_at(row)
+
+    def record_at(self, row):
+        return StudentRecord(row, int(self.ids[row]), self.keys[row],
+                             format_grades(self.grades[row]))
+
+    def memory_usage(self):
+        # Estimated bytes of memory held by this roster: the arrays, the
+        # key strings and the index dict with its int keys and values.
+        if len(self) == 0:
+            return 0
+        return (self.ids.nbytes + self.grades.nbytes
+                + sys.getsizeof(self.keys) + len(self) * sys.getsizeof(self.keys[0])
+                + sys.getsizeof(self.index) + len(self) * 2 * sys.getsizeof(int(self.ids[0])))
+
+    def update_grade(self, student_id, column, grade):
+        # Change one grade in memory and apply the difference to the
+        # class aggregates.
+        record = self.lookup(student_id)
+        if record is None:
+            return False
+        self.aggregates.update(column, self.grades[record.row, column], grade)
+        self.grades[record.row, column] = grade
+        return True
+
+    def scores(self, code):
+        # One score per student for the given column code.
+        columns = GRADE_COLUMN_CODES[code]
+        if len(columns) == 1:
+            return self.grades[:, columns[0]]
+        return self.grades[:, columns].mean(axis=1)
+
+    def statistic(self, record, command_id):
+        # Evaluate a "STAT:CODE[:ARG]" command over the whole class.
+        # Returns the result as a string, or None if the command is
+        # not valid.
+        stat, _, rest = command_id.partition(STATS_SEPARATOR)
+        code, _, arg = rest.partition(STATS_SEPARATOR)
+        if stat not in STATS_COMMANDS or code not in GRADE_COLUMN_CODES:
+            return None
+        scores = self.scores(code)
+        if len(scores) == 0:
+            return None
+        try:
+            if stat == "MED":
+                return str(float(np.median(scores)))
+            elif stat == "STD":
+                return str(float(np.std(scores)))
+            elif stat == "PCT":
+                percentile = float(arg)
+                if not 0 <= percentile <= 100:
+                    return None
+                return str(float(np.percentile(scores, percentile)))
+            elif stat == HISTOGRAM_COMMAND:
+                bins = int(arg) if arg else HISTOGRAM_BINS
+                if not 1 <= bins <= MAX_HISTOGRAM_BINS:
+                    return None
+                counts, edges = np.histogram(scores, bins=bins)
+                return str([(float(edges[i]), float(edges[i + 1]), int(counts[i]))
+                            for i in range(len(counts))])
+            elif stat == "RANK":
+                # 1 is the highest score in the class.
+                rank = int(np.count_nonzero(scores > scores[record.row])) + 1
+                return "{}/{}".format(rank, len(scores))
+        except ValueError:
+            return None
+
+    def __len__(self):
+        return len(self.ids)
+
+########################################################################
+# Binary roster snapshot
+########################################################################
+
+# A compiled roster is a fixed-width binary file that the server maps
+# into memory instead of parsing the CSV. All integers and floats are
+# little-endian.
+#
+# -------------------------------------------------------------------
+# | header | column sums (9 x f64) | record 0 | record 1 | ...       |
+# -------------------------------------------------------------------
+#
+# header: 8 byte magic, u32 version, u32 number of grade columns and
+#         u64 record count.
+# record: i64 student ID, 44 byte ASCII Fernet key, 9 x f64 grades.
+#
+# Records are sorted by student ID, so a lookup is a binary search
+# over the mapped pages and nothing has to be loaded at startup. Every
+# process that maps the file shares the same page cache copy.
+
+BINARY_ROSTER_MAGIC = b'GRDROST1'
+BINARY_ROSTER_VERSION = 1
+BINARY_ROSTER_HEADER = struct.Struct("<8sIIQ")
+BINARY_ROSTER_SUMS = struct.Struct("<{}d".format(GradeRoster.NUM_GRADE_COLUMNS))
+BINARY_ROSTER_KEY_LEN = 44
+BINARY_ROSTER_RECORD = struct.Struct("<q{}s{}d".format(BINARY_ROSTER_KEY_LEN,
+                                                        GradeRoster.NUM_GRADE_COLUMNS))
+BINARY_ROSTER_ID = struct.Struct("<q")
+BINARY_ROSTER_DATA_OFFSET = BINARY_ROSTER_HEADER.size + BINARY_ROSTER_SUMS.size
+
+def binary_roster_dtype():
+    # numpy view of one record, matching BINARY_ROSTER_RECORD.
+    return np.dtype([("id", "<i8"),
+                     ("key", "S{}".format(BINARY_ROSTER_KEY_LEN)),
+                     ("grades", "<f8", (GradeRoster.NUM_GRADE_COLUMNS,))])
+
+def compile_roster(csv_filename, binary_filename):
+    # Convert a course CSV into a binary roster snapshot. The file is
+    # written next to the target and renamed into place, so a server
+    # mapping the old snapshot is never exposed to a partial file.
+    roster = GradeRoster(csv_filename)
+    for key in roster.keys:
+        if len(key) != BINARY_ROSTER_KEY_LEN:
+            raise ValueError("Unexpected key length: {}".format(key))
+
+    order = np.argsort(roster.ids, kind="stable")
+    records = np.empty(len(roster), dtype=binary_roster_dtype())
+    records["id"] = roster.ids[order]
+    records["key"] = [roster.keys[row].encode('ascii') for row in order]
+    records["grades"] = roster.grades[order]
+
+    tmp_filename = binary_filename + ".tmp"
+    with open(tmp_filename, 'wb') as file:
+        file.write(BINARY_ROSTER_HEADER.pack(BINARY_ROSTER_MAGIC, BINARY_ROSTER_VERSION,
+                                             GradeRoster.NUM_GRADE_COLUMNS, len(records)))
+        file.write(BINARY_ROSTER_SUMS.pack(*roster.aggregates.sums.tolist()))
+        records.tofile(file)
+    os.replace(tmp_filename, binary_filename)
+    return len(records)
+
+def is_binary_roster(filename):
+    with open(filename, 'rb') as file:
+        return file.read(len(BINARY_ROSTER_MAGIC)) == BINARY_ROSTER_MAGIC
+
+def open_roster(filename):
+    # Load a roster from either a course CSV or a compiled snapshot.
+    if is_binary_roster(filename):
+        if GradeRoster.SHARD is not None:
+            raise ValueError("{}: compiled rosters cannot be sharded".format(filename))
+        return MappedRoster(filename)
+    return GradeRoster(filename)
+
+class MappedRoster(GradeRoster):
+
+    # Read-only roster backed by a memory-mapped binary snapshot. The
+    # class sums come from the file header, lookups binary search the
+    # sorted IDs, and the grade columns are only viewed as a numpy
+    # array (without copying) when a statistics command needs them.
+
+    def load(self):
+        self.mtime = os.path.getmtime(self.filename)
+        with open(self.filename, 'rb') as file:
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, num_grades, self.count = BINARY_ROSTER_HEADER.unpack_from(self.mmap, 0)
+        if (magic != BINARY_ROSTER_MAGIC or version != BINARY_ROSTER_VERSION
+                or num_grades != GradeRoster.NUM_GRADE_COLUMNS):
+            raise ValueError("{} is not a version {} binary roster".format(
+                self.filename, BINARY_ROSTER_VERSION))
+        self.header = None
+        self.journal = None
+        sums = list(BINARY_ROSTER_SUMS.unpack_from(self.mmap, BINARY_ROSTER_HEADER.size))
+        self.aggregates = GradeAggregates(self.count, sums)
+        self.records = None
+
+    @property
+    def grades(self):
+        if self.records is None:
+            self.records = np.frombuffer(self.mmap, dtype=binary_roster_dtype(),
+                                         count=self.count, offset=BINARY_ROSTER_DATA_OFFSET)
+        return self.records["grades"]
+
+    def record_offset(self, row):
+        return BINARY_ROSTER_DATA_OFFSET + row * BINARY_ROSTER_RECORD.size
+
+    def lookup(self, student_id):
+        try:
+            student_id = int(student_id)
+        except ValueError:
+            return None
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            (middle_id,) = BINARY_ROSTER_ID.unpack_from(self.mmap, self.record_offset(middle))
+            if middle_id < student_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.count:
+            return None
+        record = self.record_at(low)
+        if record.student_id != student_id:
+            return None
+        return record
+
+    def record_at(self, row):
+        fields = BINARY_ROSTER_RECORD.unpack_from(self.mmap, self.record_offset(row))
+        return StudentRecord(row, fields[0], fields[1].decode('ascii'),
+                             format_grades(fields[2:]))
+
+    def update_grade(self, student_id, column, grade):
+        # Compiled snapshots are read-only.
+        return False
+
+    def memory_usage(self):
+        # The mapped pages become resident as they are used.
+        return len(self.mmap)
+
+    def __len__(self):
+        return self.count
+
+########################################################################
+# Grade update journal
+########################################################################
 
+# Framed command that changes one grade: "UPDATE,token", where token is
+# a Fernet token made with the instructor key (--instructor-key-file)
+# holding "[course,]student_id,column,grade" and column is one of
+# GRADE_COLUMN_NAMES. Tokens older than UPDATE_TOKEN_TTL are refused,
+# and so is a token that has been used before, so an old token cannot
+# be replayed to undo a later correction.
+# The reply is "column=grade" encrypted with the instructor key. With
+# several worker processes (-n), the others pick the update up from the
+# journal when they next poll it, so for up to
+# RosterWatcher.POLL_INTERVAL they can still answer with the old grade.
+UPDATE_COMMAND = "UPDATE"
+UPDATE_TOKEN_TTL = 60 # seconds
+
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_LOCK_SUFFIX = ".lock"
+JOURNAL_COMPACTED_PREFIX = "#compacted "
+JOURNAL_TOKEN_PREFIX = "#token "
+
+class GradeJournal:
+
+    # Append-only log of the grade updates to one course CSV, kept next
+    # to it as "<csv>.journal". Each line is
+    # "student_id,column,grade,token_id,expires", where token_id
+    # identifies the UPDATE token used and expires is the time (Unix
+    # seconds) after which the server would refuse that token anyway.
+    # A line sets a grade rather than changing it by some amount, so
+    # applying a line twice is harmless. Appending is one short write,
+    # and every process serving the course tails the file to apply the
+    # updates made by the others and to learn which tokens are used.
+    #
+    # The RosterWatcher compacts the journal in the background: the
+    # grades are written into a new CSV that replaces the old one, and
+    # then the journal is replaced by one that starts with
+    # "#compacted <CSV mtime>", followed by "#token <token_id> <expires>"
+    # for every used token that has not expired yet. A process that
+    # reaches the first line knows its roster already matches the new
+    # CSV and does not reload it.
+
+    COMPACT_ENTRIES = 1000
+    COMPACT_INTERVAL = 60.0 # seconds
+    READ_SIZE = 1 << 16
+
+    def __init__(self, csv_filename):
+        self.csv_filename = csv_filename
+        self.filename = csv_filename + JOURNAL_SUFFIX
+        # Guards the read position against the watcher thread.
+        self.lock = threading.RLock()
+        self.file = None
+        # Read with pread from our own offset: worker processes forked
+        # after the roster was loaded share the open file.
+        self.offset = 0
+        self.pending = b''
+        self.entries = 0
+        self.first_entry_time = None
+        # Used update tokens, token_id -> expiry time.
+        self.tokens = {}
+
+    @contextlib.contextmanager
+    def locked(self):
+        # Serializes appends and compactions across processes. The CSV
+        # and the journal are replaced during a compaction, so the lock
+        # is held on a file of its own.
+        try:
+            import fcntl
+        except ImportError:
+            # Not available on Windows, where updates are refused.
+            raise OSError("grade updates need fcntl file locking, "
+                          "which is not available on this platform")
+        with open(self.csv_filename + JOURNAL_LOCK_SUFFIX, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def open_journal(self):
+        if self.file is not None:
+            self.file.close()
+        try:
+            self.file = open(self.filename, 'rb')
+        except FileNotFoundError:
+            self.file = None
+        self.offset = 0
+        self.pending = b''
+        self.entries = 0
+        self.first_entry_time = None
+
+    def replay(self, roster):
+        # Apply every line appended since the last call, following the
+        # journal across compactions.
+        with self.lock:
+            while True:
+                if self.file is None:
+                    self.open_journal()
+                    if self.file is None:
+                        return
+                while True:
+                    data = os.pread(self.file.fileno(), GradeJournal.READ_SIZE, self.offset)
+                    if len(data) == 0:
+                        break
+                    self.offset += len(data)
+                    self.apply_lines(roster, data)
+                try:
+                    if os.stat(self.filename).st_ino == os.fstat(self.file.fileno()).st_ino:
+                        return
+                except FileNotFoundError:
+                    return
+                # The old journal has been read to the end, carry on
+                # with its replacement.
+                self.open_journal()
+
+    def apply_lines(self, roster, data):
+        lines = (self.pending + data).split(b'\n')
+        # Keep a partly written last line for the next call.
+        self.pending = lines.pop()
+        for line in lines:
+            line = line.decode('ascii', errors='replace')
+            if line.startswith(JOURNAL_COMPACTED_PREFIX):
+                mtime = float(line[len(JOURNAL_COMPACTED_PREFIX):])
+                if os.path.getmtime(self.csv_filename) == mtime:
+                    roster.mtime = mtime
+                continue
+            try:
+                if line.startswith(JOURNAL_TOKEN_PREFIX):
+                    token_id, expires = line[len(JOURNAL_TOKEN_PREFIX):].split()
+                    self.tokens[token_id] = float(expires)
+                    continue
+                student_id, column, grade, *token = line.split(',')
+                if token:
+                    # Lines written before tokens were recorded have none.
+                    token_id, expires = token
+                    self.tokens[token_id] = float(expires)
+                roster.update_grade(student_id, int(column), float(grade))
+            except (ValueError, IndexError):
+                log.warning("Skipped bad line in %s: %s", self.filename, line)
+                continue
+            self.entries += 1
+            if self.first_entry_time is None:
+                self.first_entry_time = time.monotonic()
+
+    def append(self, roster, student_id, column, grade, token_id, expires):
+        # Record and apply one update. Returns False if the student is
+        # not in the roster or the token has been used before.
+        if roster.lookup(student_id) is None:
+            return False
+        with self.lock, self.locked():
+            # Catch up first, to know the tokens used by other processes.
+            self.replay(roster)
+            now = time.time()
+            self.tokens = {used: until for used, until in self.tokens.items() if until > now}
+            if token_id in self.tokens:
+                log.warning("Refused a replayed update token")
+                return False
+            with open(self.filename, 'ab') as file:
+                file.write("{},{},{},{},{!r}\n".format(
+                    int(student_id), column, grade, token_id, expires).encode('ascii'))
+            # Reading the journal up to the end also applies the new
+            # line, after any that other processes appended first.
+            self.replay(roster)
+        return True
+
+    def compaction_due(self):
+        return self.entries >= GradeJournal.COMPACT_ENTRIES or (
+            self.entries > 0
+            and time.monotonic() - self.first_entry_time >= GradeJournal.COMPACT_INTERVAL)
+
+    def compact(self, roster):
+        # Write the journalled grades into the CSV and start an empty
+        # journal. Returns False if there was nothing to do.
+        with self.lock, self.locked():
+            self.replay(roster)
+            if self.entries == 0:
+                # Another process got here first.
+                return False
+            if os.path.getmtime(self.csv_filename) != roster.mtime:
+                # The CSV has been edited by hand; it is reloaded (and
+                # the journal replayed over it) first.
+                return False
+
+            # The grades are taken from the journal itself rather than
+            # the roster, which (on a shard) may hold only some of the
+            # students.
+            updates = {}
+            for line in os.pread(self.file.fileno(), self.offset - len(self.pending), 0).decode('ascii').splitlines():
+                if line.startswith((JOURNAL_COMPACTED_PREFIX, JOURNAL_TOKEN_PREFIX)):
+                    continue
+                try:
+                    student_id, column, grade = line.split(',')[:3]
+                    updates.setdefault(int(student_id), {})[int(column)] = float(grade)
+                except ValueError:
+                    continue
+
+            # Copy the CSV row by row so that every other column is
+            # kept as it is.
+            first = GradeRoster.FIRST_GRADE_COLUMN
+            tmp_filename = self.csv_filename + ".tmp"
+            with open(self.csv_filename, newline='') as src, \
+                 open(tmp_filename, 'w', newline='') as dst:
+                reader = csv.reader(src)
+                writer = csv.writer(dst, lineterminator='\n')
+                writer.writerow(next(reader))
+                for row in reader:
+                    for column, grade in updates.get(int(row[GradeRoster.ID_COLUMN]), {}).items():
+                        row[first + column] = format_grades([grade])[0]
+                    writer.writerow(row)
+            os.replace(tmp_filename, self.csv_filename)
+            mtime = os.path.getmtime(self.csv_filename)
+            roster.mtime = mtime
+
+            tmp_filename = self.filename + ".tmp"
+            now = time.time()
+            with open(tmp_filename, 'w') as file:
+                file.write("{}{!r}\n".format(JOURNAL_COMPACTED_PREFIX, mtime))
+                # The grades are in the CSV now, but the tokens that set
+                # them must still be refused until they expire.
+                for token_id, expires in self.tokens.items():
+                    if expires > now:
+                        file.write("{}{} {!r}\n".format(JOURNAL_TOKEN_PREFIX, token_id, expires))
+            os.replace(tmp_filename, self.filename)
+            entries = self.entries
+            self.replay(roster)
+        log.info("Compacted %s updates into %s", entries, self.csv_filename)
+        return True
+
+########################################################################
+# Sharding
+########################################################################
+
+# A large roster can be split over several server processes, each one
+# started with "--shard i/N" and loading only its own students, behind
+# a router ("-r router") that forwards every request to the right one.
+# Students are assigned to shards either by a hash of the ID or by
+# splitting STUDENT_ID_RANGE into N equal ranges.
+SHARD_SCHEMES = ("hash", "range")
+STUDENT_ID_RANGE = (1000000, 10000000)
+SHARD_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+SHARD_HASH_MASK = (1 << 64) - 1
+
+ShardSpec = namedtuple("ShardSpec", ["index", "count", "scheme"])
+
+# Internal framed commands between the router and the shards, only
+# answered on loopback. "PARTIALS[,course]" returns the shard's own
+# {"count": n, "sums": [...]} as JSON and "TOTALS,{json}" gives it the
+# class-wide {"course": c, "count": n, "sums": [...]} used for the
+# average commands.
+SHARD_PARTIALS_COMMAND = "PARTIALS"
+SHARD_TOTALS_COMMAND = "TOTALS"
+
+def parse_shard(shard, scheme="hash"):
+    # "i/N" -> ShardSpec
+    index, count = (int(field) for field in shard.split('/'))
+    if not 0 <= index < count:
+        raise ValueError("Shard {} out of range".format(shard))
+    return ShardSpec(index, count, scheme)
+
+def shard_of(student_id, count, scheme):
+    if scheme == "range":
+        low, high = STUDENT_ID_RANGE
+        width = -(-(high - low) // count)
+        return min(max((student_id - low) // width, 0), count - 1)
+    return (((student_id * SHARD_HASH_MULTIPLIER) & SHARD_HASH_MASK) >> 32) % count
+
+def shard_of_ids(ids, shard):
+    # shard_of for a numpy array of student IDs.
+    if shard.scheme == "range":
+        low, high = STUDENT_ID_RANGE
+        width = -(-(high - low) // shard.count)
+        return np.clip((ids - low) // width, 0, shard.count - 1)
+    hashed = (ids.astype(np.uint64) * np.uint64(SHARD_HASH_MULTIPLIER)) >> np.uint64(32)
+    return (hashed % np.uint64(shard.count)).astype(np.int64)
+
+########################################################################
+# Course tables
+########################################################################
+
+def split_course(recvd_str, num_fields):
+    # Split a request of num_fields comma separated fields that may be
+    # preceded by a course ID. Returns (course, fields) or raises
+    # ValueError.
+    fields = recvd_str.split(',')
+    if len(fields) == num_fields:
+        return DEFAULT_COURSE, fields
+    if len(fields) == num_fields + 1:
+        return fields[0], fields[1:]
+    raise ValueError("Expected {} fields".format(num_fields))
+
+class CourseTableManager:
+
+    # Holds the roster of every course in use. A course is loaded from
+    # "<courses_dir>/<course>.bin" (compiled) or "<course>.csv" the
+    # first time it is requested. Loaded courses are kept in LRU order,
+    # and the least recently used ones are dropped once their estimated
+    # memory use goes over memory_budget. The default course is never
+    # dropped. A changed file is loaded into a new roster that replaces
+    # the old one in the table, which is atomic for requests already
+    # using the old one. A course whose file fails to load is not tried
+    # again for FAILED_LOAD_TTL.
+
+    MEMORY_BUDGET = 512 * 1024 * 1024 # bytes
+    FAILED_LOAD_TTL = 5.0 # seconds
+
+    def __init__(self, default_file, courses_dir=None, memory_budget=MEMORY_BUDGET):
+        self.default_file = default_file
+        self.courses_dir = courses_dir
+        self.memory_budget = memory_budget
+        self.tables = OrderedDict()
+        self.lock = threading.Lock()
+        self.loads = 0
+        self.evictions = 0
+        # Course -> time.monotonic() of its last failed load.
+        self.failed = {}
+        self.tables[DEFAULT_COURSE] = open_roster(default_file)
+
+    def course_file(self, course):
+        if course == DEFAULT_COURSE:
+            return self.default_file
+        if self.courses_dir is None or not COURSE_ID_PATTERN.match(course):
+            return None
+        for extension in (".bin", ".csv"):
+            filename = os.path.join(self.courses_dir, course + extension)
+            if os.path.isfile(filename):
+                return filename
+        return None
+
+    def is_loaded(self, course):
+        with self.lock:
+            return course in self.tables
+
+    def get(self, course=DEFAULT_COURSE):
+        # Return the roster for the course, loading it if needed, or
+        # None if there is no such course.
+        with self.lock:
+            roster = self.tables.get(course)
+            if roster is not None:
+                self.tables.move_to_end(course)
+                return roster
+            failed_time = self.failed.get(course)
+            if failed_time is not None and time.monotonic() - failed_time < CourseTableManager.FAILED_LOAD_TTL:
+                return None
+
+        filename = self.course_file(course)
+        if filename is None:
+            return None
+        start_time = time.perf_counter()
+        try:
+            roster = open_roster(filename)
+        except Exception as msg:
+            log.warning("Load of %s failed: %s", filename, msg)
+            with self.lock:
+                self.failed[course] = time.monotonic()
+            return None
+
+        with self.lock:
+            self.failed.pop(course, None)
+            # Another thread may have loaded it in the meantime.
+            if course in self.tables:
+                return self.tables[course]
+            self.tables[course] = roster
+            self.loads += 1
+            self.evict_to_budget()
+        log.info("Loaded course %s: %s students in %.1f ms",
+                 course, len(roster), (time.perf_counter() - start_time) * 1000)
+        return roster
+
+    def evict_to_budget(self):
+        # Called with the lock held. The most recently used course (the
+        # one just loaded) and the default course always stay.
+        usage = sum(roster.memory_usage() for roster in self.tables.values())
+        for course in list(self.tables)[:-1]:
+            if usage <= self.memory_budget:
+                break
+            if course == DEFAULT_COURSE:
+                continue
+            usage -= self.tables.pop(course).memory_usage()
+            self.evictions += 1
+            log.info("Evicted course %s", course)
+
+    def sync_journals(self):
+        # Apply the grade updates made by other processes and compact
+        # the journals that have grown.
+        with self.lock:
+            rosters = list(self.tables.values())
+        for roster in rosters:
+            if roster.journal is None:
+                continue
+            try:
+                roster.journal.replay(roster)
+                if roster.journal.compaction_due():
+                    roster.journal.compact(roster)
+            except OSError as msg:
+                log.warning("Journal of %s: %s", roster.filename, msg)
+
+    def reload_changed(self):
+        # Rebuild every loaded roster whose file has changed. The new
+        # snapshot is built without holding the lock and then swapped
+        # in, so requests never wait for a reload or see a partially
+        # loaded roster.
+        with self.lock:
+            tables = list(self.tables.items())
+        for course, roster in tables:
+            try:
+                mtime = os.path.getmtime(roster.filename)
+            except OSError:
+                continue
+            if mtime == roster.mtime:
+                continue
+            start_time = time.perf_counter()
+            try:
+                new_roster = open_roster(roster.filename)
+            except Exception as msg:
+                # Most likely the file is still being written. Keep the
+                # current snapshot and try again on the next poll.
+                log.warning("Reload of %s failed: %s", roster.filename, msg)
+                continue
+            if new_roster.mtime != os.path.getmtime(roster.filename):
+                # Changed again while we were reading it.
+                continue
+            with self.lock:
+                if self.tables.get(course) is roster:
+                    self.tables[course] = new_roster
+            log.info("Reloaded %s: %s students in %.1f ms",
+                     roster.filename, len(new_roster), (time.perf_counter() - start_time) * 1000)
+
+    def stats(self):
+        with self.lock:
+            return {"loaded": len(self.tables),
+                    "memory_bytes": sum(roster.memory_usage() for roster in self.tables.values()),
+                    "memory_budget": self.memory_budget,
+                    "loads": self.loads,
+                    "evictions": self.evictions}
+
+class RosterWatcher(threading.Thread):
+
+    # Background thread that keeps the grade journals in sync, polls
+    # the modification time of every loaded course file and has the
+    # CourseTableManager swap in a new roster when one changes.
+
+    POLL_INTERVAL = 1.0 # seconds
+
+    def __init__(self, courses, interval=POLL_INTERVAL):
+        super().__init__(daemon=True)
+        self.courses = courses
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.courses.sync_journals()
+            self.courses.reload_changed()
+
+########################################################################
+# Server metrics
+########################################################################
+
+# Admin command, sent on its own instead of "student_id,command_id",
+# that returns the server metrics as JSON. Only answered on loopback.
+STATS_ADMIN_COMMAND = "STATS"
+LOOPBACK_ADDRESSES = ("127.0.0.1", "::1")
+
+# Framed admin command that streams every student's GG record. The
+# server answers with one "student_id,token" frame per roster row, each
+# token encrypted with that student's key, followed by an empty frame.
+# Also only answered on loopback.
+EXPORT_ADMIN_COMMAND = "EXPORT"
+
+class ServerMetrics:
+
+    # In-process counters: requests per command, errors per kind,
+    # bytes in and out, and latency histograms for the lookup,
+    # encryption and send stages of each request. In the multi-process
+    # mode every worker keeps its own.
+
+    # Upper bounds (ms) of the latency histogram buckets. The last
+    # bucket counts everything slower.
+    LATENCY_BUCKETS_MS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000)
+    TIMERS = ("lookup", "encrypt", "send")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.connections = 0
+        self.requests = {}
+        self.errors = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency_counts = {timer: [0] * (len(ServerMetrics.LATENCY_BUCKETS_MS) + 1)
+                               for timer in ServerMetrics.TIMERS}
+        self.latency_sums = {timer: 0.0 for timer in ServerMetrics.TIMERS}
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def count_request(self, command_id):
+        with self.lock:
+            self.requests[command_id] = self.requests.get(command_id, 0) + 1
+
+    def count_error(self, kind):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def add_bytes(self, bytes_in=0, bytes_out=0):
+        with self.lock:
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+
+    def observe(self, timer, seconds):
+        milliseconds = seconds * 1000
+        bucket = bisect.bisect_left(ServerMetrics.LATENCY_BUCKETS_MS, milliseconds)
+        with self.lock:
+            self.latency_counts[timer][bucket] += 1
+            self.latency_sums[timer] += milliseconds
+
+    def snapshot(self):
+        with self.lock:
+            latency = {}
+            for timer in ServerMetrics.TIMERS:
+                counts = self.latency_counts[timer]
+                latency[timer] = {
+                    "count": sum(counts),
+                    "sum_ms": round(self.latency_sums[timer], 3),
+                    "buckets_ms": dict(zip([str(bound) for bound in ServerMetrics.LATENCY_BUCKETS_MS]
+                                           + ["inf"], counts)),
+                }
+            return {
+                "uptime_s": round(time.time() - self.start_time, 3),
+                "connections": self.connections,
+                "requests": dict(self.requests),
+                "errors": dict(self.errors),
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "latency": latency,
+            }
+
+########################################################################
+# Echo Server class
+########################################################################
 
 class Server:
 
@@ -68,9 +1220,68 @@ class Server:
     # address/hostname and port.
     SOCKET_ADDRESS = (HOSTNAME, PORT)
 
-    def __init__(self):
-        self.create_listen_socket()
-        self.process_connections_forever()
+    # Course roster containing the student IDs, keys and grades.
+    GRADES_FILE = 'course_grades_2024.csv'
+
+    # Serving modes. "serial" handles one connection at a time.
+    # "asyncio" multiplexes all client connections on one event loop
+    # so that slow or idle clients do not hold up anyone else.
+    MODES = ("serial", "asyncio")
+    ASYNC_CONNECTION_BACKLOG = 1024 # Used for listen in asyncio mode.
+
+    def __init__(self, mode="serial", port=PORT, grades_file=GRADES_FILE, processes=1,
+                 courses_dir=None, course_memory_budget=CourseTableManager.MEMORY_BUDGET,
+                 instructor_key=None, shard=None):
+        self.mode = mode
+        self.port = port
+        self.grades_file = grades_file
+        self.processes = processes
+        self.courses_dir = courses_dir
+        self.course_memory_budget = course_memory_budget
+        # Fernet key that authorizes grade updates. Without one the
+        # UPDATE command is refused.
+        self.instructor_key = instructor_key
+        # ShardSpec if this server holds one shard of the roster, and
+        # the class-wide totals per course pushed by the router.
+        self.shard = shard
+        self.class_totals = {}
+        # Course loads in flight in asyncio mode, by course.
+        self.course_loads = {}
+        if self.shard is not None and self.processes > 1:
+            # The router pushes the class totals over one connection,
+            # which reaches only one of the worker processes.
+            print("A shard server runs as a single process, not with -n {}".format(self.processes))
+            sys.exit(1)
+        self.metrics = ServerMetrics()
+        self.load_roster()
+        if self.processes > 1:
+            self.process_connections_prefork()
+        else:
+            self.create_listen_socket()
+            self.serve()
+
+    def load_roster(self):
+        try:
+            #server has started, read in the csv file once and keep
+            #it indexed by student id for the lifetime of the server.
+            #other courses are loaded when they are first requested.
+            GradeRoster.SHARD = self.shard
+            self.courses = CourseTableManager(self.grades_file, self.courses_dir,
+                                              self.course_memory_budget)
+            roster = self.courses.get(DEFAULT_COURSE)
+            #1st row defines meaning of columns
+            #entries 2 and 3 in rows are the student id and the key
+            print("Data read from {}: \n".format(self.grades_file))
+            if roster.header is not None:
+                print(roster.header)
+            print("{} students".format(len(roster)))
+            if self.courses_dir is not None:
+                print("Serving courses from {}".format(self.courses_dir))
+            if self.shard is not None:
+                print("Shard {}/{} by {}".format(self.shard.index, self.shard.count, self.shard.scheme))
+        except Exception as msg:
+            print(msg)
+            sys.exit(1)
 
     def create_listen_socket(self):
         try:
@@ -81,26 +1292,116 @@ class Server:
             # reuse the socket address without waiting for any timeouts.
             self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
+            # With several worker processes each one binds its own
+            # socket to the same port and the kernel spreads incoming
+            # connections across them.
+            if self.processes > 1:
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
             # Bind socket to socket address, i.e., IP address and port.
-            self.socket.bind(Server.SOCKET_ADDRESS)
+            self.socket.bind((Server.HOSTNAME, self.port))
 
             # Set socket to listen state.
-            self.socket.listen(Server.MAX_CONNECTION_BACKLOG)
-            
-            #server has started, read in the csv file
-            with open('course_grades_2024.csv', 'r') as file:
-                reader = csv.reader(file)
-                #1st row defines meaning of columns
-                #entries 2 and 3 in rows are the student id and the key
-                print("Dara read from CSV file: \n")
-                for row in reader:
-                    print(row)
+            if self.mode == "asyncio":
+                self.socket.listen(Server.ASYNC_CONNECTION_BACKLOG)
+            else:
+                self.socket.listen(Server.MAX_CONNECTION_BACKLOG)
 
-            print("Listening on port {} ...".format(Server.PORT))
+            print("Listening on port {} ({} mode, pid {}) ...".format(self.port, self.mode, os.getpid()))
+            print("Startup time: {:.1f} ms".format(startup_time_ms()))
         except Exception as msg:
             print(msg)
             sys.exit(1)
 
+    def serve(self):
+        self.roster_watcher = RosterWatcher(self.courses)
+        self.roster_watcher.start()
+        if self.mode == "asyncio":
+            self.process_connections_async()
+        else:
+            self.process_connections_forever()
+
+    def process_connections_prefork(self):
+        # Fork the worker processes after the roster has been loaded,
+        # so they all start from the same copy-on-write roster pages
+        # (or the same page cache pages for a compiled snapshot). Each
+        # worker has its own GIL, so encryption scales across cores.
+        if not hasattr(os, "fork") or not hasattr(socket, "SO_REUSEPORT"):
+            print("Multiple processes need fork() and SO_REUSEPORT")
+            sys.exit(1)
+
+        workers = []
+        for _ in range(self.processes):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    self.create_listen_socket()
+                    self.serve()
+                finally:
+                    os._exit(1)
+            workers.append(pid)
+        print("Started {} worker processes: {}".format(len(workers), workers))
+
+        # Treat a SIGTERM like Ctrl-C so the workers are stopped too.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+        try:
+            for pid in workers:
+                os.waitpid(pid, 0)
+        except KeyboardInterrupt:
+            print()
+        finally:
+            # Make sure that no worker outlives the parent.
+            for pid in workers:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            sys.exit(1)
+
+    def request_course(self, payload, state=None):
+        # The course that handle_request or handle_frame will look up
+        # for this payload, or None if it does not name one. UPDATE
+        # tokens are opened in the thread pool, so they are not looked
+        # into here.
+        if state is not None and state.get("session") is not None:
+            return state["session"].course
+        try:
+            recvd_str = payload.decode(Server.MSG_ENCODING)
+            command, _, argument = recvd_str.partition(',')
+            if command == SESSION_COMMAND:
+                return split_course(argument, 2)[0]
+            if command in (EXPORT_ADMIN_COMMAND, SHARD_PARTIALS_COMMAND):
+                return argument
+            if command in (STATS_ADMIN_COMMAND, UPDATE_COMMAND, SHARD_TOTALS_COMMAND):
+                return None
+            return split_course(recvd_str, 2)[0]
+        except (UnicodeDecodeError, ValueError):
+            return None
+
+    async def async_load_course(self, course):
+        # Parsing a course file can take seconds, so in asyncio mode a
+        # course that is not loaded yet is loaded in the thread pool
+        # while the event loop carries on serving everyone else.
+        # Requests for the same course wait on the one load in flight.
+        if course is None or self.courses.is_loaded(course):
+            return
+        future = self.course_loads.get(course)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(None, self.courses.get, course)
+            self.course_loads[course] = future
+            future.add_done_callback(lambda _: self.course_loads.pop(course, None))
+        # Shielded so that one waiter going away does not cancel the
+        # load for the others.
+        await asyncio.shield(future)
+
+    def course_roster(self, course):
+        # Roster snapshot for the course, or None if it does not exist.
+        roster = self.courses.get(course)
+        if roster is None:
+            log.debug("Course not found: %s", course)
+            self.metrics.count_error("unknown_course")
+        return roster
+
     def process_connections_forever(self):
         try:
             while True:
@@ -120,13 +1421,115 @@ class Server:
             self.socket.close()
             sys.exit(1)
 
+    def process_connections_async(self):
+        try:
+            asyncio.run(self.serve_async())
+        except Exception as msg:
+            print(msg)
+        except KeyboardInterrupt:
+            print()
+        finally:
+            self.socket.close()
+            sys.exit(1)
+
+    async def serve_async(self):
+        # Hand the already bound listen socket to asyncio. Every
+        # accepted connection gets its own coroutine; all of them
+        # share the same roster.
+        server = await asyncio.start_server(self.async_connection_handler,
+                                            sock=self.socket)
+        async with server:
+            await server.serve_forever()
+
+    async def async_connection_handler(self, reader, writer):
+        address_port = writer.get_extra_info('peername')
+        log.info("Connection received from %s.", address_port)
+        self.metrics.count_connection()
+
+        try:
+            # Framed clients start with a 0x00 byte.
+            first_byte = await reader.read(1)
+            if first_byte == FRAMED_PROTOCOL_MARKER:
+                await self.async_framed_connection_handler(reader, writer, first_byte, address_port)
+                return
+            recvd_bytes = first_byte
+            if len(recvd_bytes) > 0:
+                recvd_bytes += await reader.read(Server.RECV_BUFFER_SIZE - 1)
+            while len(recvd_bytes) > 0:
+                await self.async_load_course(self.request_course(recvd_bytes))
+                encrypted_message_bytes = self.handle_request(recvd_bytes, address_port)
+                await self.async_send(writer, encrypted_message_bytes)
+                recvd_bytes = await reader.read(Server.RECV_BUFFER_SIZE)
+        except (ConnectionError, asyncio.IncompleteReadError) as msg:
+            log.info(msg)
+        finally:
+            log.info("Closing client connection %s ... ", address_port)
+            writer.close()
+
+    async def async_framed_connection_handler(self, reader, writer, first_byte, address_port):
+        # Per-connection protocol state (the session, once opened).
+        state = {}
+        length_field = first_byte + await reader.readexactly(FRAME_LENGTH_FIELD_LEN - 1)
+        while True:
+            length = int.from_bytes(length_field, byteorder='big')
+            if length > MAX_FRAME_SIZE:
+                log.warning("Frame too large from %s", address_port)
+                break
+            payload = await reader.readexactly(length)
+            self.metrics.add_bytes(bytes_in=FRAME_LENGTH_FIELD_LEN)
+            await self.async_load_course(self.request_course(payload, state))
+            command = payload.split(b',')[0]
+            if command == EXPORT_ADMIN_COMMAND.encode(Server.MSG_ENCODING):
+                await self.async_export_roster(writer, address_port, payload)
+            elif command == UPDATE_COMMAND.encode(Server.MSG_ENCODING) and state.get("session") is None:
+                # An update can wait on the journal lock while a
+                # compaction rewrites the CSV, so it runs in the thread
+                # pool rather than on the event loop.
+                response = await asyncio.get_running_loop().run_in_executor(
+                    None, self.handle_frame, payload, address_port, state)
+                await self.async_send(writer, encode_frame(response))
+            else:
+                response = self.handle_frame(payload, address_port, state)
+                if response is None:
+                    break
+                await self.async_send(writer, encode_frame(response))
+            try:
+                length_field = await reader.readexactly(FRAME_LENGTH_FIELD_LEN)
+            except asyncio.IncompleteReadError:
+                # Client closed the connection between frames.
+                break
+
+    async def async_send(self, writer, response):
+        start_time = time.perf_counter()
+        writer.write(response)
+        await writer.drain()
+        self.metrics.observe("send", time.perf_counter() - start_time)
+        self.metrics.add_bytes(bytes_out=len(response))
+        log.debug("Sent: %r", response)
+
+    def send(self, connection, response):
+        start_time = time.perf_counter()
+        connection.sendall(response)
+        self.metrics.observe("send", time.perf_counter() - start_time)
+        self.metrics.add_bytes(bytes_out=len(response))
+        log.debug("Sent: %r", response)
+
     def connection_handler(self, client):
         # Unpack the client socket address tuple.
         connection, address_port = client
-        print("-" * 72)
-        print("Connection received from {}.".format(address_port))
-        # Output the socket address.
-        print(client)
+        log.info("Connection received from %s.", address_port)
+        self.metrics.count_connection()
+
+        # Framed clients start with a 0x00 byte. Peek at it without
+        # consuming it.
+        try:
+            first_byte = connection.recv(1, socket.MSG_PEEK)
+        except ConnectionError as msg:
+            log.info(msg)
+            first_byte = b''
+        if first_byte == FRAMED_PROTOCOL_MARKER:
+            self.framed_connection_handler(connection, address_port)
+            return
 
         while True:
             try:
@@ -135,9 +1538,6 @@ class Server:
                 # Receive bytes over the TCP connection. This will block
                 # until "at least 1 byte or more" is available.
                 recvd_bytes = connection.recv(Server.RECV_BUFFER_SIZE)
-                
-                #initialize the encrypted msg
-                encrypted_message_bytes = bytes("0", 'utf-8')
 
                 # If recv returns with zero bytes, the other end of the
                 # TCP connection has closed (The other end is probably in
@@ -145,120 +1545,12 @@ class Server:
                 # server end of the connection and get the next client
                 # connection.
                 if len(recvd_bytes) == 0:
-                    print("Closing client connection ... ")
+                    log.info("Closing client connection %s ... ", address_port)
                     connection.close()
                     break
-                
-                # Decode the received bytes back into strings. Then output
-                # them.
-                recvd_str = recvd_bytes.decode(Server.MSG_ENCODING)
-                print("Received: ", recvd_str)
-
-                #get the student id and the key from the rcvd client 
-                student_id, command_id = recvd_str.split(',')
-                print("Student ID: ", student_id)
-                print("Recieved Command ID: ", command_id)
-                
-                # ==== New Decryption Code ====
-                #load data from csv file
-                encrypt_key = ""
-                data = []
-     
-                #store data by rows using pandas
-                df = pd.read_csv('course_grades_2024.csv')
-                data = df.values.tolist()
-                
-                #now check if the student id (2) is in the csv file
-                #if it is, then get the key (3)
-                #print given student id and id 1 from csv
-                print("User found, student ID: ", student_id)
-
-                for row in data:
-                    if ((row[1]) == int(student_id)):
-                        encrypt_key = row[2]
-                        
-                        #user was found, return data the command is requesting
-                        #init user grade data
-                        num_grades = 0
-                        sum_grades = 0
-                        if command_id == "GMA":
-                            # get midterm (col 8) average of class
-                            for row in data[1:]: #skipping header row
-                                sum_grades += float(row[7])
-                                num_grades += 1
-                            avg_midterm_grade = sum_grades / num_grades
-                            encrypted_message_bytes = encrypt(str(avg_midterm_grade), encrypt_key)
-                            print("GMA: Encrypted: ", encrypted_message_bytes)
-                            print("GMA: avg midterm grade: ", avg_midterm_grade)
-                            break
-                        elif command_id == "GL1A":
-                            # get lab 1 average of class (col 4)
-                            for row in data[1:]: #skipping header row
-                                sum_grades += float(row[3])
-                                num_grades += 1
-                            avg_lab1_grade = sum_grades / num_grades
-                            encrypted_message_bytes = encrypt(str(avg_lab1_grade), encrypt_key)
-                            print("GL1A: Encrypted: ", encrypted_message_bytes)
-                            print("GL1A: avg lab 1 grade: ", avg_lab1_grade)
-                            break
-                        elif command_id == "GL2A":
-                            # get lab 2 average of class (col 5)
-                            for row in data[1:]: #skipping header row
-                                sum_grades += float(row[4])
-                                num_grades += 1
-                            avg_lab2_grade = sum_grades / num_grades
-                            encrypted_message_bytes = encrypt(str(avg_lab2_grade), encrypt_key)
-                            print("GL1A: Encrypted: ", encrypted_message_bytes)
-                            print("GL1A: avg lab 2 grade: ", avg_lab2_grade)
-                            break
-                        elif command_id == "GL3A":
-                            # get lab 3 average of class (col 6)
-                            for row in data[1:]: #skipping header row
-                                sum_grades += float(row[5])
-                                num_grades += 1
-                            avg_lab3_grade = sum_grades / num_grades
-                            encrypted_message_bytes = encrypt(str(avg_lab3_grade), encrypt_key)
-                            print("GL1A: Encrypted: ", encrypted_message_bytes)
-                            print("GL1A: avg lab 3 grade: ", avg_lab3_grade)
-                            break
-                        elif command_id == "GL4A":
-                            # get lab 4 average of class (col 7)
-                            for row in data[1:]: #skipping header row
-                                sum_grades += float(row[6])
-                                num_grades += 1
-                            avg_lab4_grade = sum_grades / num_grades
-                            encrypted_message_bytes = encrypt(str(avg_lab4_grade), encrypt_key)
-                            print("GL1A: Encrypted: ", encrypted_message_bytes)
-                            print("GL1A: avg lab 4 grade: ", avg_lab4_grade)
-                            break                       
-                        elif command_id == "GEA":
-                            # get exam average of class (col 9-12)
-                            for row in data[1:]: #skipping header row
-                                sum_grades += float(row[8]) + float(row[9]) + float(row[10]) + float(row[11])  
-                                num_grades += 4
-                            avg_exam_grade = sum_grades / num_grades
-                            encrypted_message_bytes = encrypt(str(avg_exam_grade), encrypt_key)
-                            print("GEA: Encrypted: ", encrypted_message_bytes)
-                            print("GEA: avg exam grade: ", avg_exam_grade)
-                            break                         
-                        elif command_id == "GG":
-                            # get all grades of students as a list col 4 - 12
-                            grades = []
-                            grades.append(row[3:12])
-                            encrypted_message_bytes = encrypt(str(grades), encrypt_key)
-                            print("GG: Encrypted: ", encrypted_message_bytes)
-                            print("GG: grades: ", grades)
-                            break                       
-                        else:
-                            print("Command ID not found")
-                            break
-                    #else if looped through all rows and student id not found
-                    elif (row == data[-1]):
-                        print("Student ID not found")
-                        break
 
-                connection.sendall(encrypted_message_bytes)
-                print("Sent: ", encrypted_message_bytes)
+                encrypted_message_bytes = self.handle_request(recvd_bytes, address_port)
+                self.send(connection, encrypted_message_bytes)
 
                 # ==== Original Echo Code ====
                 # Send the received bytes back to the client. We are
@@ -266,12 +1558,729 @@ class Server:
                 #connection.sendall(recvd_bytes)
                 #print("Sent: ", recvd_str)
 
+            except ConnectionError as msg:
+                log.info(msg)
+                connection.close()
+                break
             except KeyboardInterrupt:
                 print()
                 print("Closing client connection ... ")
                 connection.close()
                 break
 
+    def framed_connection_handler(self, connection, address_port):
+        # Serve pipelined frames until the client closes.
+        # Per-connection protocol state (the session, once opened).
+        state = {}
+        try:
+            while True:
+                payload = recv_frame(connection)
+                if payload is None:
+                    break
+                self.metrics.add_bytes(bytes_in=FRAME_LENGTH_FIELD_LEN)
+                if payload.split(b',')[0] == EXPORT_ADMIN_COMMAND.encode(Server.MSG_ENCODING):
+                    self.export_roster(connection, address_port, payload)
+                else:
+                    response = self.handle_frame(payload, address_port, state)
+                    if response is None:
+                        break
+                    self.send(connection, encode_frame(response))
+        except (ConnectionError, KeyboardInterrupt) as msg:
+            log.info(msg)
+        log.info("Closing client connection %s ... ", address_port)
+        connection.close()
+
+    # In asyncio mode, give other connections a turn on the event loop
+    # after this many exported records.
+    EXPORT_YIELD_INTERVAL = 64
+
+    def export_frames(self, address_port, payload):
+        # Generate the export frames one roster row at a time, so that
+        # memory use does not depend on the size of the roster. The
+        # payload is "EXPORT" or "EXPORT,course".
+        roster = None
+        if address_port is None or address_port[0] not in LOOPBACK_ADDRESSES:
+            log.warning("Refused EXPORT from %s", address_port)
+            self.metrics.count_error("forbidden")
+        else:
+            try:
+                _, _, course = payload.decode(Server.MSG_ENCODING).partition(',')
+                roster = self.course_roster(course)
+            except UnicodeDecodeError:
+                self.metrics.count_error("malformed_request")
+        if roster is None:
+            yield encode_frame(b'0')
+            yield encode_frame(b'')
+            return
+        log.info("Exporting roster to %s", address_port)
+        self.metrics.count_request(EXPORT_ADMIN_COMMAND)
+        for row in range(len(roster)):
+            record = roster.record_at(row)
+            start_time = time.perf_counter()
+            token = encrypt(str([record.grades]), record.key, cache=False)
+            self.metrics.observe("encrypt", time.perf_counter() - start_time)
+            yield encode_frame("{},".format(record.student_id).encode(Server.MSG_ENCODING) + token)
+        yield encode_frame(b'')
+
+    def export_roster(self, connection, address_port, payload):
+        # sendall blocks while the client is not reading, which
+        # throttles the export to the client's pace.
+        for frame in self.export_frames(address_port, payload):
+            self.send(connection, frame)
+
+    async def async_export_roster(self, writer, address_port, payload):
+        # async_send waits for drain(), so the export never runs ahead
+        # of what the client has read.
+        for count, frame in enumerate(self.export_frames(address_port, payload), 1):
+            await self.async_send(writer, frame)
+            if count % Server.EXPORT_YIELD_INTERVAL == 0:
+                await asyncio.sleep(0)
+
+    def handle_request(self, recvd_bytes, address_port=None):
+        # Process one "student_id,command_id" request and return the
+        # encrypted response bytes. This is shared by every serving
+        # mode.
+        self.metrics.add_bytes(bytes_in=len(recvd_bytes))
+
+        #initialize the encrypted msg
+        encrypted_message_bytes = bytes("0", 'utf-8')
+
+        # Decode the received bytes back into strings. Then output
+        # them.
+        try:
+            recvd_str = recvd_bytes.decode(Server.MSG_ENCODING)
+        except UnicodeDecodeError:
+            recvd_str = ""
+        log.debug("Received: %s", recvd_str)
+
+        if recvd_str == STATS_ADMIN_COMMAND:
+            return self.admin_stats(address_port)
+
+        #get the student id and the key from the rcvd client 
+        try:
+            course, (student_id, command_id) = split_course(recvd_str, 2)
+        except ValueError:
+            log.debug("Malformed request")
+            self.metrics.count_error("malformed_request")
+            return encrypted_message_bytes
+        log.debug("Course: %s, Student ID: %s, Command ID: %s", course, student_id, command_id)
+
+        if command_id.partition(STATS_SEPARATOR)[0] == HISTOGRAM_COMMAND:
+            log.debug("Histograms are only sent on framed connections")
+            self.metrics.count_error("unknown_command")
+            return encrypted_message_bytes
+
+        # Use one roster snapshot for the whole request.
+        start_time = time.perf_counter()
+        roster = self.course_roster(course)
+        if roster is None:
+            return encrypted_message_bytes
+        record = self.find_student(roster, student_id)
+        if record is None:
+            return encrypted_message_bytes
+
+        result = self.command_result(course, roster, record, command_id)
+        self.metrics.observe("lookup", time.perf_counter() - start_time)
+        if result is not None:
+            start_time = time.perf_counter()
+            encrypted_message_bytes = encrypt(result, record.key)
+            self.metrics.observe("encrypt", time.perf_counter() - start_time)
+            log.debug("%s: Encrypted: %r", command_id, encrypted_message_bytes)
+
+        return encrypted_message_bytes
+
+    def handle_frame(self, payload, address_port=None, state=None):
+        # Process one framed "student_id,CMD1+CMD2+..." request. All
+        # of the results go back in a single encrypted response. Once
+        # a session has been opened on the connection, frames are
+        # session frames instead. Returns None if the connection should
+        # be closed.
+        self.metrics.add_bytes(bytes_in=len(payload))
+        if state is not None and state.get("session") is not None:
+            return self.handle_session_frame(state["session"], payload)
+        if payload == STATS_ADMIN_COMMAND.encode(Server.MSG_ENCODING):
+            return self.admin_stats(address_port)
+        try:
+            recvd_str = payload.decode(Server.MSG_ENCODING)
+            command, _, handshake = recvd_str.partition(',')
+            if command == SESSION_COMMAND and state is not None:
+                return self.open_session(handshake, state)
+            if command == UPDATE_COMMAND:
+                return self.update_grade(handshake)
+            if command in (SHARD_PARTIALS_COMMAND, SHARD_TOTALS_COMMAND):
+                return self.shard_sync(command, handshake, address_port)
+            course, (student_id, command_ids) = split_course(recvd_str, 2)
+        except (UnicodeDecodeError, ValueError):
+            log.debug("Malformed request")
+            self.metrics.count_error("malformed_request")
+            return b'0'
+        log.debug("Received: %s", recvd_str)
+
+        # Use one roster snapshot for the whole request.
+        start_time = time.perf_counter()
+        roster = self.course_roster(course)
+        if roster is None:
+            return b'0'
+        record = self.find_student(roster, student_id)
+        if record is None:
+            return b'0'
+        response = self.batch_results(course, roster, record, command_ids)
+        self.metrics.observe("lookup", time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        encrypted_message_bytes = encrypt(response, record.key)
+        self.metrics.observe("encrypt", time.perf_counter() - start_time)
+        return encrypted_message_bytes
+
+    def batch_results(self, course, roster, record, command_ids):
+        lines = []
+        for command_id in command_ids.split(BATCH_SEPARATOR):
+            result = self.command_result(course, roster, record, command_id)
+            if result is None:
+                result = "Command ID not found"
+            lines.append(command_id + "=" + result)
+        return "\n".join(lines)
+
+    def update_grade(self, token):
+        # token is a Fernet token made with the instructor key. It is
+        # refused once it is older than UPDATE_TOKEN_TTL, and until then
+        # the journal records it as used, so that replaying it cannot
+        # undo a later update.
+        if self.instructor_key is None:
+            self.metrics.count_error("forbidden")
+            return b'0'
+        try:
+            fernet = cipher_cache.get(self.instructor_key)
+            token_bytes = token.encode('ascii')
+            request = fernet.decrypt(token_bytes, ttl=UPDATE_TOKEN_TTL)
+            request = request.decode(Server.MSG_ENCODING)
+            expires = fernet.extract_timestamp(token_bytes) + UPDATE_TOKEN_TTL
+            token_id = hashlib.sha256(token_bytes).hexdigest()[:32]
+        except Exception:
+            log.warning("Rejected grade update")
+            self.metrics.count_error("unauthorized")
+            return b'0'
+        try:
+            course, (student_id, column_name, grade) = split_course(request, 3)
+            column = GRADE_COLUMN_NAMES.index(column_name)
+            grade = float(grade)
+            if not math.isfinite(grade) or grade < 0:
+                raise ValueError
+        except ValueError:
+            self.metrics.count_error("malformed_request")
+            return b'0'
+        roster = self.course_roster(course)
+        if roster is None:
+            return b'0'
+        try:
+            # Compiled rosters are read-only.
+            updated = roster.journal is not None and roster.journal.append(
+                roster, student_id, column, grade, token_id, expires)
+        except OSError as msg:
+            log.warning("Update of %s failed: %s", roster.filename, msg)
+            updated = False
+        if not updated:
+            self.metrics.count_error("update_refused")
+            return b'0'
+        self.metrics.count_request(UPDATE_COMMAND)
+        log.info("Updated %s of %s to %s", column_name, student_id, grade)
+        return encrypt("{}={}".format(column_name, grade), self.instructor_key)
+
+    def open_session(self, handshake, state):
+        # handshake is "[course,]student_id,client_nonce_hex".
+        try:
+            course, (student_id, client_nonce_hex) = split_course(handshake, 2)
+            client_nonce = bytes.fromhex(client_nonce_hex)
+            if len(client_nonce) != SESSION_NONCE_LEN:
+                raise ValueError
+        except ValueError:
+            self.metrics.count_error("malformed_request")
+            return b'0'
+        roster = self.course_roster(course)
+        if roster is None:
+            return b'0'
+        record = self.find_student(roster, student_id)
+        if record is None:
+            return b'0'
+        server_nonce = os.urandom(SESSION_NONCE_LEN)
+        session = GradeSession(record.student_id, record.key, client_nonce, server_nonce,
+                               is_server=True, course=course)
+        state["session"] = session
+        self.metrics.count_request(SESSION_COMMAND)
+        log.debug("Session opened for student ID: %s", record.student_id)
+        return server_nonce + session.seal(SESSION_CONFIRMATION)
+
+    def handle_session_frame(self, session, payload):
+        from cryptography.exceptions import InvalidTag
+
+        start_time = time.perf_counter()
+        try:
+            command_ids = session.open(payload).decode(Server.MSG_ENCODING)
+        except (InvalidTag, UnicodeDecodeError):
+            log.warning("Session frame failed authentication, closing")
+            self.metrics.count_error("bad_session_frame")
+            return None
+        self.metrics.observe("encrypt", time.perf_counter() - start_time)
+        log.debug("Received (session): %s", command_ids)
+
+        start_time = time.perf_counter()
+        roster = self.course_roster(session.course)
+        record = None if roster is None else self.find_student(roster, session.student_id)
+        if record is None:
+            response = "0"
+        else:
+            response = self.batch_results(session.course, roster, record, command_ids)
+        self.metrics.observe("lookup", time.perf_counter() - start_time)
+
+        start_time = time.perf_counter()
+        sealed = session.seal(response.encode(Server.MSG_ENCODING))
+        self.metrics.observe("encrypt", time.perf_counter() - start_time)
+        return sealed
+
+    def admin_stats(self, address_port):
+        # The metrics are returned as plain JSON, so they are only
+        # given out to clients on this machine.
+        if address_port is None or address_port[0] not in LOOPBACK_ADDRESSES:
+            log.warning("Refused STATS from %s", address_port)
+            self.metrics.count_error("forbidden")
+            return b'0'
+        stats = self.metrics.snapshot()
+        stats["pid"] = os.getpid()
+        stats["mode"] = self.mode
+        stats["students"] = len(self.courses.get(DEFAULT_COURSE))
+        stats["courses"] = self.courses.stats()
+        stats["cipher_cache"] = cipher_cache.stats()
+        if self.shard is not None:
+            stats["shard"] = "{}/{}".format(self.shard.index, self.shard.count)
+        return json.dumps(stats).encode(Server.MSG_ENCODING)
+
+    def class_aggregates(self, course, roster):
+        # A shard's own sums only cover its students. It answers the
+        # average commands from the totals pushed by the router, and
+        # not at all until the first push.
+        if self.shard is None:
+            return roster.aggregates
+        return self.class_totals.get(course)
+
+    def shard_sync(self, command, argument, address_port):
+        # Answer the router's PARTIALS and TOTALS commands.
+        if self.shard is None or address_port is None or address_port[0] not in LOOPBACK_ADDRESSES:
+            self.metrics.count_error("forbidden")
+            return b'0'
+        try:
+            if command == SHARD_PARTIALS_COMMAND:
+                roster = self.course_roster(argument)
+                if roster is None:
+                    return b'0'
+                partials = {"count": roster.aggregates.count,
+                            "sums": [float(total) for total in roster.aggregates.sums]}
+                return json.dumps(partials).encode(Server.MSG_ENCODING)
+            totals = json.loads(argument)
+            self.class_totals[totals["course"]] = GradeAggregates(int(totals["count"]),
+                                                                  [float(total) for total in totals["sums"]])
+            return b'1'
+        except (ValueError, KeyError, TypeError):
+            self.metrics.count_error("malformed_request")
+            return b'0'
+
+    def find_student(self, roster, student_id):
+        # ==== New Decryption Code ====
+        #look up the student in the roster index
+        record = roster.lookup(student_id)
+        if record is None:
+            log.debug("Student ID not found")
+            self.metrics.count_error("unknown_student")
+        else:
+            log.debug("User found, student ID: %s", student_id)
+        return record
+
+    def command_result(self, course, roster, record, command_id):
+        # Return the plain text answer to one command for the student
+        # in record, or None if the command is not known.
+        result = None
+        if command_id in AVERAGE_COMMANDS:
+            # class averages come straight from the
+            # precomputed aggregates
+            aggregates = self.class_aggregates(course, roster)
+            if aggregates is not None:
+                result = str(aggregates.average(command_id))
+        elif command_id == "GG":
+            # get all grades of students as a list col 4 - 12
+            grades = []
+            grades.append(record.grades)
+            result = str(grades)
+        elif STATS_SEPARATOR in command_id and self.shard is None:
+            # A shard only has some of the class, so statistics over
+            # the whole class are not available in sharded mode.
+            result = roster.statistic(record, command_id)
+
+        if result is None:
+            log.debug("Command ID not found: %s", command_id)
+            self.metrics.count_error("unknown_command")
+        else:
+            log.debug("%s: %s", command_id, result)
+            # Count statistics commands by name only, not by argument.
+            self.metrics.count_request(command_id.split(STATS_SEPARATOR)[0])
+        return result
+
+########################################################################
+# Shard router
+########################################################################
+
+class ShardConnectionPool:
+
+    # Idle connections to one shard for one protocol. A request takes
+    # a connection (opening a new one if fewer than size are in use),
+    # makes one round trip on it and puts it back.
+
+    def __init__(self, host, port, framed, size):
+        self.host = host
+        self.port = port
+        self.framed = framed
+        self.idle = []
+        self.semaphore = asyncio.Semaphore(size)
+
+    async def request(self, payload):
+        async with self.semaphore:
+            if self.idle:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            try:
+                if self.framed:
+                    writer.write(encode_frame(payload))
+                    await writer.drain()
+                    length_field = await reader.readexactly(FRAME_LENGTH_FIELD_LEN)
+                    response = await reader.readexactly(int.from_bytes(length_field, byteorder='big'))
+                else:
+                    writer.write(payload)
+                    await writer.drain()
+                    response = await reader.read(Server.RECV_BUFFER_SIZE)
+                    if len(response) == 0:
+                        raise ConnectionError("Shard closed the connection")
+            except BaseException:
+                writer.close()
+                raise
+            self.idle.append((reader, writer))
+            return response
+
+class ShardRouter:
+
+    # Front end for a roster split over shard servers. Requests are
+    # forwarded unchanged, still encrypted end to end, to the shard
+    # that holds the student over a pool of connections per shard, so
+    # the router needs no keys. Frames from one client are forwarded
+    # concurrently and answered in order. Every SYNC_INTERVAL the
+    # router adds up the shards' partial class sums and sends the
+    # totals back to them, so averages cover the whole class (and may
+    # be up to one interval behind a grade update).
+
+    SYNC_INTERVAL = 1.0 # seconds
+    POOL_SIZE = 32 # connections per shard and protocol
+    PIPELINE_DEPTH = 64 # frames in flight per client connection
+
+    def __init__(self, shards, port=Server.PORT, scheme="hash"):
+        self.shards = shards
+        self.port = port
+        self.scheme = scheme
+        self.metrics = ServerMetrics()
+        self.forwarded = [0] * len(shards)
+        # Courses whose averages are kept in sync.
+        self.courses = {DEFAULT_COURSE}
+        try:
+            asyncio.run(self.serve())
+        except Exception as msg:
+            print(msg)
+        except KeyboardInterrupt:
+            print()
+        finally:
+            sys.exit(1)
+
+    async def serve(self):
+        self.pools = [(ShardConnectionPool(host, port, False, ShardRouter.POOL_SIZE),
+                       ShardConnectionPool(host, port, True, ShardRouter.POOL_SIZE))
+                      for host, port in self.shards]
+        server = await asyncio.start_server(self.connection_handler, Server.HOSTNAME,
+                                            self.port, reuse_address=True,
+                                            backlog=Server.ASYNC_CONNECTION_BACKLOG)
+        print("Routing port {} to {} shards by {}: {}".format(
+            self.port, len(self.shards), self.scheme,
+            ", ".join("{}:{}".format(host, port) for host, port in self.shards)))
+        print("Startup time: {:.1f} ms".format(startup_time_ms()))
+        sync_task = asyncio.ensure_future(self.sync_totals_forever())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            sync_task.cancel()
+
+    def shard_for(self, request):
+        # Shard of a "[course,]student_id,..." request, and its course.
+        course, (student_id, _) = split_course(request, 2)
+        return shard_of(int(student_id), len(self.shards), self.scheme), course
+
+    async def forward(self, shard, framed, payload):
+        # Returns the shard's response, or b'0' if it cannot be reached.
+        try:
+            response = await self.pools[shard][framed].request(payload)
+        except (OSError, asyncio.IncompleteReadError) as msg:
+            log.warning("Shard %s unavailable: %s", shard, msg)
+            self.metrics.count_error("shard_unavailable")
+            return b'0'
+        self.forwarded[shard] += 1
+        return response
+
+    async def connection_handler(self, reader, writer):
+        address_port = writer.get_extra_info('peername')
+        log.info("Connection received from %s.", address_port)
+        self.metrics.count_connection()
+        try:
+            first_byte = await reader.read(1)
+            if first_byte == FRAMED_PROTOCOL_MARKER:
+                await self.framed_connection_handler(reader, writer, first_byte, address_port)
+                return
+            recvd_bytes = first_byte
+            if len(recvd_bytes) > 0:
+                recvd_bytes += await reader.read(Server.RECV_BUFFER_SIZE - 1)
+            while len(recvd_bytes) > 0:
+                writer.write(await self.route_legacy(recvd_bytes, address_port))
+                await writer.drain()
+                recvd_bytes = await reader.read(Server.RECV_BUFFER_SIZE)
+        except (ConnectionError, asyncio.IncompleteReadError) as msg:
+            log.info(msg)
+        finally:
+            log.info("Closing client connection %s ... ", address_port)
+            writer.close()
+
+    async def route_legacy(self, recvd_bytes, address_port):
+        self.metrics.add_bytes(bytes_in=len(recvd_bytes))
+        try:
+            recvd_str = recvd_bytes.decode(Server.MSG_ENCODING)
+            if recvd_str == STATS_ADMIN_COMMAND:
+                return await self.admin_stats(address_port)
+            shard, course = self.shard_for(recvd_str)
+        except (UnicodeDecodeError, ValueError):
+            self.metrics.count_error("malformed_request")
+            return b'0'
+        response = await self.forward(shard, False, recvd_bytes)
+        if response != b'0':
+            self.courses.add(course)
+        return response
+
+    async def route_frame(self, payload, address_port):
+        self.metrics.add_bytes(bytes_in=len(payload))
+        try:
+            recvd_str = payload.decode(Server.MSG_ENCODING)
+            command, _, argument = recvd_str.partition(',')
+            if command == STATS_ADMIN_COMMAND:
+                return await self.admin_stats(address_port)
+            if command == UPDATE_COMMAND:
+                # The router cannot read the update token, so every
+                # shard gets it and the one holding the student applies
+                # it.
+                responses = await asyncio.gather(*[self.forward(shard, True, payload)
+                                                   for shard in range(len(self.shards))])
+                return next((response for response in responses if response != b'0'), b'0')
+            if command in (SHARD_PARTIALS_COMMAND, SHARD_TOTALS_COMMAND):
+                # Only the router itself may send these to the shards.
+                self.metrics.count_error("forbidden")
+                return b'0'
+            shard, course = self.shard_for(recvd_str)
+        except (UnicodeDecodeError, ValueError):
+            self.metrics.count_error("malformed_request")
+            return b'0'
+        response = await self.forward(shard, True, payload)
+        if response != b'0':
+            self.courses.add(course)
+        return response
+
+    async def framed_connection_handler(self, reader, writer, first_byte, address_port):
+        # Responses are queued in request order as they are being
+        # forwarded. The queue is bounded, so a client that does not
+        # read its responses stops being read from.
+        responses = asyncio.Queue(ShardRouter.PIPELINE_DEPTH)
+        sender = asyncio.ensure_future(self.send_responses(writer, responses, address_port))
+        try:
+            length_field = first_byte + await reader.readexactly(FRAME_LENGTH_FIELD_LEN - 1)
+            while True:
+                length = int.from_bytes(length_field, byteorder='big')
+                if length > MAX_FRAME_SIZE:
+                    log.warning("Frame too large from %s", address_port)
+                    break
+                payload = await reader.readexactly(length)
+                command = payload.split(b',', 1)[0]
+                if command == SESSION_COMMAND.encode(Server.MSG_ENCODING):
+                    # A session lives on one shard connection, so the
+                    # rest of this connection is relayed to it.
+                    await responses.put(None)
+                    await sender
+                    await self.relay_session(reader, writer, payload)
+                    return
+                if command == EXPORT_ADMIN_COMMAND.encode(Server.MSG_ENCODING):
+                    await responses.put(("export", payload))
+                else:
+                    await responses.put(("frame", asyncio.ensure_future(
+                        self.route_frame(payload, address_port))))
+                try:
+                    length_field = await reader.readexactly(FRAME_LENGTH_FIELD_LEN)
+                except asyncio.IncompleteReadError:
+                    break
+        finally:
+            if not sender.done():
+                await responses.put(None)
+                await sender
+
+    async def send_responses(self, writer, responses, address_port):
+        while True:
+            item = await responses.get()
+            if item is None:
+                return
+            kind, value = item
+            if kind == "export":
+                await self.export(writer, value, address_port)
+                continue
+            response = encode_frame(await value)
+            writer.write(response)
+            await writer.drain()
+            self.metrics.add_bytes(bytes_out=len(response))
+
+    async def export(self, writer, payload, address_port):
+        # Stream each shard's export in turn, with a single end frame.
+        # The shards see the router's loopback address, so the check
+        # is made here.
+        if address_port is None or address_port[0] not in LOOPBACK_ADDRESSES:
+            log.warning("Refused EXPORT from %s", address_port)
+            self.metrics.count_error("forbidden")
+            writer.write(encode_frame(b'0') + encode_frame(b''))
+            await writer.drain()
+            return
+        for host, port in self.shards:
+            shard_reader, shard_writer = await asyncio.open_connection(host, port)
+            try:
+                shard_writer.write(encode_frame(payload))
+                while True:
+                    length_field = await shard_reader.readexactly(FRAME_LENGTH_FIELD_LEN)
+                    frame = await shard_reader.readexactly(int.from_bytes(length_field, byteorder='big'))
+                    if len(frame) == 0:
+                        break
+                    writer.write(length_field + frame)
+                    await writer.drain()
+            finally:
+                shard_writer.close()
+        writer.write(encode_frame(b''))
+        await writer.drain()
+
+    async def relay_session(self, reader, writer, handshake):
+        try:
+            shard, _ = self.shard_for(handshake.decode(Server.MSG_ENCODING).partition(',')[2])
+        except (UnicodeDecodeError, ValueError):
+            self.metrics.count_error("malformed_request")
+            writer.write(encode_frame(b'0'))
+            return
+        host, port = self.shards[shard]
+        shard_reader, shard_writer = await asyncio.open_connection(host, port)
+        shard_writer.write(encode_frame(handshake))
+        self.forwarded[shard] += 1
+
+        async def pipe(src, dst):
+            while True:
+                data = await src.read(Server.RECV_BUFFER_SIZE * 64)
+                if len(data) == 0:
+                    break
+                dst.write(data)
+                await dst.drain()
+            dst.close()
+        try:
+            await asyncio.gather(pipe(reader, shard_writer), pipe(shard_reader, writer))
+        except ConnectionError as msg:
+            log.info(msg)
+        finally:
+            shard_writer.close()
+
+    async def admin_stats(self, address_port):
+        if address_port is None or address_port[0] not in LOOPBACK_ADDRESSES:
+            log.warning("Refused STATS from %s", address_port)
+            self.metrics.count_error("forbidden")
+            return b'0'
+        stats = self.metrics.snapshot()
+        stats["pid"] = os.getpid()
+        stats["mode"] = "router"
+        stats["forwarded"] = self.forwarded
+        stats["shards"] = []
+        for shard in range(len(self.shards)):
+            response = await self.forward(shard, True, STATS_ADMIN_COMMAND.encode(Server.MSG_ENCODING))
+            stats["shards"].append(None if response == b'0' else json.loads(response))
+        return json.dumps(stats).encode(Server.MSG_ENCODING)
+
+    async def sync_totals_forever(self):
+        while True:
+            for course in list(self.courses):
+                await self.sync_totals(course)
+            await asyncio.sleep(ShardRouter.SYNC_INTERVAL)
+
+    async def sync_totals(self, course):
+        request = SHARD_PARTIALS_COMMAND
+        if course:
+            request = "{},{}".format(SHARD_PARTIALS_COMMAND, course)
+        responses = await asyncio.gather(*[
+            self.forward(shard, True, request.encode(Server.MSG_ENCODING))
+            for shard in range(len(self.shards))])
+        if b'0' in responses:
+            # Totals with a shard missing would be wrong, so the shards
+            # keep the previous ones.
+            return
+        count = 0
+        sums = [0.0] * GradeRoster.NUM_GRADE_COLUMNS
+        for response in responses:
+            partials = json.loads(response)
+            count += partials["count"]
+            sums = [total + partial for total, partial in zip(sums, partials["sums"])]
+        totals = json.dumps({"course": course, "count": count, "sums": sums})
+        request = "{},{}".format(SHARD_TOTALS_COMMAND, totals).encode(Server.MSG_ENCODING)
+        await asyncio.gather(*[self.forward(shard, True, request)
+                               for shard in range(len(self.shards))])
+
+########################################################################
+# Client key store
+########################################################################
+
+class ClientKeyStore:
+
+    # The client only needs the student keys from the course CSV. They
+    # are read once (with the csv module, not pandas) into a dict keyed
+    # by student ID, and the file is read again only when its
+    # modification time changes.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mtime = None
+        self.keys = {}
+        self.reload_if_changed()
+
+    def reload_if_changed(self):
+        try:
+            mtime = os.path.getmtime(self.filename)
+        except OSError:
+            return False
+        if mtime == self.mtime:
+            return False
+        # Only two columns are needed, so the csv module is enough.
+        with open(self.filename, newline='') as file:
+            reader = csv.reader(file)
+            next(reader)
+            self.keys = {int(row[GradeRoster.ID_COLUMN]): row[GradeRoster.KEY_COLUMN]
+                         for row in reader}
+        self.mtime = mtime
+        return True
+
+    def get(self, student_id):
+        # Return the key for the student, or None if there is none.
+        self.reload_if_changed()
+        try:
+            return self.keys.get(int(student_id))
+        except ValueError:
+            return None
+
 ########################################################################
 # Echo Client class
 ########################################################################
@@ -291,7 +2300,10 @@ class Client:
     RECV_BUFFER_SIZE = 1024 # Used for recv.    
     # RECV_BUFFER_SIZE = 5 # Used for recv.    
 
-    def __init__(self):
+    def __init__(self, port=Server.PORT, grades_file=Server.GRADES_FILE, course=None):
+        self.port = port
+        self.course = course
+        self.key_store = ClientKeyStore(grades_file)
         self.get_socket()
         self.connect_to_server()
         self.send_console_input_forever()
@@ -313,8 +2325,9 @@ class Client:
     def connect_to_server(self):
         try:
             # Connect to the server using its socket address tuple.
-            self.socket.connect((Client.SERVER_HOSTNAME, Server.PORT))
-            print("Connected to \"{}\" on port {}".format(Client.SERVER_HOSTNAME, Server.PORT))
+            self.socket.connect((Client.SERVER_HOSTNAME, self.port))
+            print("Connected to \"{}\" on port {}".format(Client.SERVER_HOSTNAME, self.port))
+            print("Startup time: {:.1f} ms".format(startup_time_ms()))
         except Exception as msg:
             print(msg)
             sys.exit(1)
@@ -340,6 +2353,8 @@ class Client:
                 print("Fetching Exam Average")
 
             self.input_text_ALL = f'{self.input_text1},{self.input_text2}'
+            if self.course:
+                self.input_text_ALL = f'{self.course},{self.input_text_ALL}'
             if self.input_text1 != "":
                 break
     
@@ -381,18 +2396,12 @@ class Client:
                 self.socket.close()
                 sys.exit(1)
 
-            encrypt_key = ""
-            #read in the key from the csv file
-            df = pd.read_csv('course_grades_2024.csv')
-            data = df.values.tolist()
             #get the key for the student id
-            for row in data:
-                if int(row[1]) == int(self.input_text1):
-                    encrypt_key = str(row[2])
-                    break
-                elif (row == data[-1]):
-                    print("Student ID not found")
-                    break
+            encrypt_key = self.key_store.get(self.input_text1)
+            if encrypt_key is None:
+                print("Student ID not found")
+                print("Received: ", recvd_bytes)
+                return
             #need to decrypt the message received from the server
             decrypted_message = decypt(recvd_bytes, encrypt_key)
             print("Received: ", decrypted_message)
@@ -401,6 +2410,256 @@ class Client:
             print(msg)
             sys.exit(1)
 
+########################################################################
+# Framed (pipelining) client
+########################################################################
+
+class FramedClient:
+
+    # Client for the framed protocol. Requests are written without
+    # waiting for earlier responses, up to PIPELINE_DEPTH outstanding,
+    # and the responses come back in request order.
+
+    PIPELINE_DEPTH = 64
+
+    def __init__(self, hostname=Client.SERVER_HOSTNAME, port=Server.PORT, course=None):
+        self.socket = socket.create_connection((hostname, port))
+        self.session = None
+        # Course ID prefixed to every request, or None for the server's
+        # default course.
+        self.course = course
+
+    def with_course(self, request):
+        if self.course:
+            return "{},{}".format(self.course, request)
+        return request
+
+    def open_session(self, student_id, key):
+        # Switch the connection to session mode for one student. After
+        # this, responses are returned already decrypted as text and
+        # the student_id passed to send_request is ignored.
+        client_nonce = os.urandom(SESSION_NONCE_LEN)
+        handshake = "{},{}".format(SESSION_COMMAND, self.with_course(
+            "{},{}".format(student_id, client_nonce.hex())))
+        self.socket.sendall(encode_frame(handshake.encode(Server.MSG_ENCODING)))
+        payload = self.recv_response()
+        if payload == b'0':
+            raise PermissionError("Session refused by the server")
+        server_nonce = payload[:SESSION_NONCE_LEN]
+        session = GradeSession(int(student_id), key, client_nonce, server_nonce,
+                               is_server=False)
+        # Raises InvalidTag if the server does not hold the same key.
+        if session.open(payload[SESSION_NONCE_LEN:]) != SESSION_CONFIRMATION:
+            raise PermissionError("Session confirmation mismatch")
+        self.session = session
+
+    def send_request(self, student_id, command_ids):
+        if self.session is not None:
+            request = BATCH_SEPARATOR.join(command_ids).encode(Server.MSG_ENCODING)
+            self.socket.sendall(encode_frame(self.session.seal(request)))
+            return
+        request = self.with_course("{},{}".format(student_id, BATCH_SEPARATOR.join(command_ids)))
+        self.socket.sendall(encode_frame(request.encode(Server.MSG_ENCODING)))
+
+    def recv_response(self):
+        payload = recv_frame(self.socket)
+        if payload is None:
+            raise ConnectionError("Server closed the connection")
+        if self.session is not None:
+            return self.session.open(payload).decode(Server.MSG_ENCODING)
+        return payload
+
+    def query(self, requests):
+        # requests is a list of (student_id, [command_id, ...]). The
+        # encrypted responses (decrypted text in session mode) are
+        # returned in the same order.
+        responses = []
+        outstanding = 0
+        for student_id, command_ids in requests:
+            if outstanding == FramedClient.PIPELINE_DEPTH:
+                responses.append(self.recv_response())
+                outstanding -= 1
+            self.send_request(student_id, command_ids)
+            outstanding += 1
+        while outstanding > 0:
+            responses.append(self.recv_response())
+            outstanding -= 1
+        return responses
+
+    def export(self):
+        # Generate (student_id, token) for every student in the roster
+        # (loopback only). Each token decrypts with that student's key
+        # to the same text as a GG reply.
+        request = EXPORT_ADMIN_COMMAND
+        if self.course:
+            request = "{},{}".format(EXPORT_ADMIN_COMMAND, self.course)
+        self.socket.sendall(encode_frame(request.encode(Server.MSG_ENCODING)))
+        while True:
+            payload = self.recv_response()
+            if len(payload) == 0:
+                return
+            if payload == b'0':
+                raise PermissionError("Export refused by the server")
+            student_id, _, token = payload.partition(b',')
+            yield int(student_id), token
+
+    def update_grade(self, instructor_key, student_id, column, grade):
+        # Change one grade; column is one of GRADE_COLUMN_NAMES.
+        # Returns the server's confirmation, e.g. "M=17.5".
+        request = self.with_course("{},{},{}".format(student_id, column, grade))
+        token = cipher_cache.get(instructor_key).encrypt(request.encode(Server.MSG_ENCODING))
+        self.socket.sendall(encode_frame(UPDATE_COMMAND.encode(Server.MSG_ENCODING) + b',' + token))
+        payload = self.recv_response()
+        if payload == b'0':
+            raise PermissionError("Update refused by the server")
+        return decypt(payload, instructor_key)
+
+    def stats(self):
+        # Fetch the server metrics (loopback only).
+        self.socket.sendall(encode_frame(STATS_ADMIN_COMMAND.encode(Server.MSG_ENCODING)))
+        return json.loads(self.recv_response())
+
+    def close(self):
+        self.socket.close()
+
+########################################################################
+# Batch queries
+########################################################################
+
+def decrypt_replies(items):
+    # Decrypt a chunk of (token, key) pairs in a worker process. Returns
+    # the reply text, or None where the server or the key said no.
+    replies = []
+    for token, key in items:
+        if token == b'0' or key is None:
+            replies.append(None)
+            continue
+        try:
+            replies.append(decypt(token, key))
+        except Exception:
+            replies.append(None)
+    return replies
+
+class BatchClient:
+
+    # Non-interactive client for reports. Reads "student_id,command"
+    # lines from a file (or stdin with "-"), sends all the commands for
+    # a student in one framed batch request, spreads the students over
+    # several pipelined connections, decrypts the replies in a process
+    # pool and writes one row per input line, in input order, as CSV or
+    # JSON.
+
+    CONNECTIONS = 4
+    DECRYPT_CHUNK_SIZE = 256
+
+    def __init__(self, input_file, port=Server.PORT, grades_file=Server.GRADES_FILE,
+                 course=None, connections=CONNECTIONS, workers=None,
+                 output_file=None, output_format="csv"):
+        self.port = port
+        self.course = course
+        self.connections = max(1, connections)
+        self.workers = workers or os.cpu_count() or 1
+        self.key_store = ClientKeyStore(grades_file)
+
+        start_time = time.perf_counter()
+        queries = self.read_queries(input_file)
+        rows = self.run(queries)
+        self.write_rows(rows, output_file, output_format)
+        # Keep stdout for the report itself.
+        print("{} queries for {} students in {:.1f} ms, {} lines skipped".format(
+            len(queries), len(self.students), (time.perf_counter() - start_time) * 1000,
+            self.skipped), file=sys.stderr)
+
+    def read_queries(self, input_file):
+        # Blank lines, comments and a "student_id,command" header are
+        # skipped. Any other line that is not a numeric ID and a
+        # command is reported on stderr and skipped.
+        file = sys.stdin if input_file == "-" else open(input_file, newline='')
+        try:
+            queries = []
+            self.skipped = 0
+            first_row = True
+            reader = csv.reader(file)
+            for row in reader:
+                if not row or row[0].startswith('#'):
+                    continue
+                fields = [field.strip() for field in row[:2]]
+                if len(fields) == 2 and fields[0].isdigit():
+                    queries.append(tuple(fields))
+                elif not (first_row and len(fields) == 2):
+                    print("Skipped line {}: {}".format(reader.line_num, ",".join(row)),
+                          file=sys.stderr)
+                    self.skipped += 1
+                first_row = False
+            return queries
+        finally:
+            if file is not sys.stdin:
+                file.close()
+
+    def run(self, queries):
+        # Group the commands by student so each student is one request.
+        self.students = OrderedDict()
+        for student_id, command_id in queries:
+            self.students.setdefault(student_id, []).append(command_id)
+        requests = list(self.students.items())
+
+        # Every connection pipelines its share of the requests.
+        tokens = [None] * len(requests)
+        def query_share(first):
+            client = FramedClient(Client.SERVER_HOSTNAME, self.port, self.course)
+            try:
+                indexes = range(first, len(requests), self.connections)
+                for index, token in zip(indexes, client.query([requests[i] for i in indexes])):
+                    tokens[index] = token
+            finally:
+                client.close()
+        threads = [threading.Thread(target=query_share, args=(first,))
+                   for first in range(min(self.connections, len(requests)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if any(token is None for token in tokens):
+            raise ConnectionError("Batch query did not complete")
+
+        items = [(token, self.key_store.get(student_id))
+                 for token, (student_id, _) in zip(tokens, requests)]
+        replies = self.decrypt(items)
+
+        # Split each reply into its "CMD=result" lines.
+        results = {}
+        for (student_id, _), reply in zip(requests, replies):
+            results[student_id] = {} if reply is None else parse_batch_response(reply)
+        return [(student_id, command_id, results[student_id].get(command_id))
+                for student_id, command_id in queries]
+
+    def decrypt(self, items):
+        chunks = [items[i:i + BatchClient.DECRYPT_CHUNK_SIZE]
+                  for i in range(0, len(items), BatchClient.DECRYPT_CHUNK_SIZE)]
+        if self.workers == 1 or len(chunks) <= 1:
+            return [reply for chunk in chunks for reply in decrypt_replies(chunk)]
+        # Imported here so the interactive client does not pay for it.
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(self.workers, len(chunks))) as pool:
+            return [reply for replies in pool.map(decrypt_replies, chunks) for reply in replies]
+
+    def write_rows(self, rows, output_file, output_format):
+        file = sys.stdout if output_file is None else open(output_file, 'w', newline='')
+        try:
+            if output_format == "json":
+                json.dump([{"student_id": int(student_id), "command": command_id,
+                            "result": result}
+                           for student_id, command_id, result in rows], file, indent=1)
+                file.write("\n")
+            else:
+                writer = csv.writer(file)
+                writer.writerow(["student_id", "command", "result"])
+                for student_id, command_id, result in rows:
+                    writer.writerow([student_id, command_id, "" if result is None else result])
+        finally:
+            if file is not sys.stdout:
+                file.close()
+
 ########################################################################
 # Process command line arguments if this module is run directly.
 ########################################################################
@@ -411,7 +2670,7 @@ class Client:
 # then __name__ will be set to that module's name.
 
 if __name__ == '__main__':
-    roles = {'client': Client,'server': Server}
+    roles = {'client': Client,'server': Server, 'router': ShardRouter}
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-r', '--role',
@@ -419,8 +2678,143 @@ if __name__ == '__main__':
                         help='server or client role',
                         required=True, type=str)
 
+    parser.add_argument('-m', '--mode',
+                        choices=Server.MODES, default="serial",
+                        help='server connection handling mode',
+                        type=str)
+
+    parser.add_argument('-p', '--port',
+                        default=Server.PORT,
+                        help='server port',
+                        type=int)
+
+    parser.add_argument('-g', '--grades-file',
+                        default=Server.GRADES_FILE,
+                        help='course grades CSV file served',
+                        type=str)
+
+    parser.add_argument('--courses-dir',
+                        default=None,
+                        help='directory of <course>.csv or <course>.bin files served on demand',
+                        type=str)
+
+    parser.add_argument('--course-memory-mb',
+                        default=CourseTableManager.MEMORY_BUDGET // (1024 * 1024),
+                        help='memory budget for loaded course tables',
+                        type=int)
+
+    parser.add_argument('--course',
+                        default=None,
+                        help='course to query (client); default is the server\'s grades file',
+                        type=str)
+
+    parser.add_argument('-b', '--batch',
+                        default=None,
+                        help='client: run the "student_id,command" queries in this file ("-" for stdin)',
+                        type=str)
+
+    parser.add_argument('--connections',
+                        default=BatchClient.CONNECTIONS,
+                        help='client: connections used by a batch run',
+                        type=int)
+
+    parser.add_argument('--workers',
+                        default=None,
+                        help='client: decryption processes used by a batch run (default: CPU count)',
+                        type=int)
+
+    parser.add_argument('-o', '--output',
+                        default=None,
+                        help='client: batch output file (default: stdout)',
+                        type=str)
+
+    parser.add_argument('--format',
+                        choices=("csv", "json"), default="csv",
+                        help='client: batch output format',
+                        type=str)
+
+    parser.add_argument('--instructor-key-file',
+                        default=None,
+                        help='file holding the Fernet key that authorizes grade updates',
+                        type=str)
+
+    parser.add_argument('-u', '--update',
+                        default=None,
+                        help='client: set one grade, "student_id,column,grade" (needs --instructor-key-file)',
+                        type=str)
+
+    parser.add_argument('--shard',
+                        default=None,
+                        help='server: serve shard i of N of the roster, as "i/N"',
+                        type=str)
+
+    parser.add_argument('--shards',
+                        default=None,
+                        help='router: shard servers in shard order, "host:port,host:port,..."',
+                        type=str)
+
+    parser.add_argument('--shard-by',
+                        choices=SHARD_SCHEMES, default="hash",
+                        help='how student IDs are assigned to shards',
+                        type=str)
+
+    parser.add_argument('--parser',
+                        choices=("auto", "pandas", "csv"), default="auto",
+                        help='CSV parser used to load the roster',
+                        type=str)
+
+    parser.add_argument('-n', '--processes',
+                        default=1,
+                        help='number of server worker processes',
+                        type=int)
+
+    parser.add_argument('-l', '--log-level',
+                        choices=("DEBUG", "INFO", "WARNING", "ERROR"), default="INFO",
+                        help='server logging level; DEBUG logs every request',
+                        type=str)
+
     args = parser.parse_args()
-    roles[args.role]()
+    logging.basicConfig(level=args.log_level, format="%(message)s")
+    GradeRoster.PARSER = args.parser
+    instructor_key = None
+    if args.instructor_key_file is not None:
+        with open(args.instructor_key_file) as file:
+            instructor_key = file.read().strip()
+    if args.role == 'server':
+        shard = None
+        if args.shard is not None:
+            shard = parse_shard(args.shard, args.shard_by)
+        Server(mode=args.mode, port=args.port, grades_file=args.grades_file,
+               processes=args.processes, courses_dir=args.courses_dir,
+               course_memory_budget=args.course_memory_mb * 1024 * 1024,
+               instructor_key=instructor_key, shard=shard)
+    elif args.role == 'router':
+        if args.shards is None:
+            print("The router needs --shards")
+            sys.exit(1)
+        shards = [(host, int(port)) for host, port in
+                  (address.rsplit(':', 1) for address in args.shards.split(','))]
+        ShardRouter(shards, port=args.port, scheme=args.shard_by)
+    elif args.update is not None:
+        if instructor_key is None:
+            print("--update needs --instructor-key-file")
+            sys.exit(1)
+        student_id, column, grade = args.update.split(',')
+        client = FramedClient(Client.SERVER_HOSTNAME, args.port, args.course)
+        try:
+            print(client.update_grade(instructor_key, student_id, column, grade))
+        except PermissionError as msg:
+            print(msg)
+            sys.exit(1)
+        finally:
+            client.close()
+    elif args.batch is not None:
+        BatchClient(args.batch, port=args.port, grades_file=args.grades_file,
+                    course=args.course, connections=args.connections,
+                    workers=args.workers, output_file=args.output,
+                    output_format=args.format)
+    else:
+        Client(port=args.port, grades_file=args.grades_file, course=args.course)
 
 ########################################################################
 
@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Compile a course grades CSV into the binary roster snapshot that the
+# Lab 2 grade server can memory-map, e.g.
+#
+#   python3 compile_roster.py course_grades_2024.csv course_grades_2024.bin
+#   python3 EncryptedGradeRetr.py -r server -g course_grades_2024.bin
+#
+# See "Binary roster snapshot" in EncryptedGradeRetr.py for the format.
+#
+########################################################################
+
+import argparse
+import time
+
+from EncryptedGradeRetr import compile_roster
+
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile a grade CSV to a binary roster")
+    parser.add_argument('csv_file', help='course grades CSV file', type=str)
+    parser.add_argument('binary_file', help='binary roster file to write', type=str)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    count = compile_roster(args.csv_file, args.binary_file)
+    print("Compiled {} students into {} in {:.1f} ms".format(
+        count, args.binary_file, (time.perf_counter() - start_time) * 1000))
+
+########################################################################
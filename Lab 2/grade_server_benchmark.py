@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+########################################################################
+#
+# Load generator and latency benchmark for the Lab 2 grade server.
+#
+# Starts EncryptedGradeRetr.py as a server on loopback (or targets one
+# that is already running), drives it with a number of concurrent
+# client connections sending a weighted mix of commands, and prints a
+# JSON report with the throughput and latency percentiles, e.g.
+#
+#   python3 grade_server_benchmark.py --server-mode asyncio \
+#       --roster-size 100000 --concurrency 200 --mix GG=4,GMA=1,GEA=1
+#
+########################################################################
+
+import argparse
+import asyncio
+import base64
+import csv
+import json
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from EncryptedGradeRetr import (BINARY_ROSTER_DATA_OFFSET, BINARY_ROSTER_HEADER,
+                                BINARY_ROSTER_RECORD, is_binary_roster)
+
+########################################################################
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "EncryptedGradeRetr.py")
+
+HEADER = ["Name", "ID Number", "Key", "Lab 1", "Lab 2", "Lab 3", "Lab 4",
+          "Midterm", "Exam 1", "Exam 2", "Exam 3", "Exam 4"]
+
+# Must match the framed protocol in EncryptedGradeRetr.py.
+FRAME_LENGTH_FIELD_LEN = 4
+BATCH_SEPARATOR = "+"
+
+MSG_ENCODING = "ascii"
+RECV_BUFFER_SIZE = 1024
+
+SERVER_START_TIMEOUT = 60 # seconds
+
+########################################################################
+# Synthetic rosters
+########################################################################
+
+def write_synthetic_roster(filename, roster_size, seed=0):
+    # Write a roster in the same layout as course_grades_2024.csv and
+    # return the list of student IDs in it.
+    rng = random.Random(seed)
+    student_ids = rng.sample(range(1000000, 9999999), roster_size)
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(HEADER)
+        for i, student_id in enumerate(student_ids):
+            # Same format as Fernet.generate_key().
+            key = base64.urlsafe_b64encode(os.urandom(32)).decode('ascii')
+            grades = [rng.randint(0, 10) for _ in range(4)] + [rng.randint(0, 20)] \
+                     + [rng.randint(0, 10) for _ in range(4)]
+            writer.writerow(["Student {}".format(i), student_id, key] + grades)
+    return student_ids
+
+def read_roster_ids(filename):
+    # Student IDs of a course CSV or of a compiled binary roster (see
+    # compile_roster.py).
+    if is_binary_roster(filename):
+        with open(filename, 'rb') as file:
+            _, _, _, count = BINARY_ROSTER_HEADER.unpack(file.read(BINARY_ROSTER_HEADER.size))
+            file.seek(BINARY_ROSTER_DATA_OFFSET)
+            data = file.read(count * BINARY_ROSTER_RECORD.size)
+        return [record[0] for record in BINARY_ROSTER_RECORD.iter_unpack(data)]
+    with open(filename, newline='') as file:
+        reader = csv.reader(file)
+        next(reader)
+        return [int(row[1]) for row in reader]
+
+########################################################################
+# Server process
+########################################################################
+
+def start_server(server_mode, port, grades_file, processes=1, shard=None):
+    args = ["-r", "server", "-m", server_mode, "-p", str(port), "-g", grades_file,
+            "-n", str(processes)]
+    if shard is not None:
+        args += ["--shard", shard]
+    return start_process(args, port)
+
+def start_sharded_servers(server_mode, port, grades_file, shards):
+    # The shards listen on the ports following the router's. Each shard
+    # is a single process. Returns every process started, router last.
+    servers = [start_server(server_mode, port + 1 + i, grades_file, 1,
+                            "{}/{}".format(i, shards))
+               for i in range(shards)]
+    addresses = ",".join("127.0.0.1:{}".format(port + 1 + i) for i in range(shards))
+    servers.append(start_process(["-r", "router", "-p", str(port), "--shards", addresses], port))
+    return servers
+
+def start_process(args, port):
+    process = subprocess.Popen(
+        [sys.executable, SERVER_SCRIPT] + args,
+        cwd=os.path.dirname(SERVER_SCRIPT),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    # Wait until the server accepts connections.
+    deadline = time.monotonic() + SERVER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Server exited with status {}".format(process.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Server did not start within {} s".format(SERVER_START_TIMEOUT))
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+########################################################################
+# Load generation
+########################################################################
+
+def parse_mix(mix):
+    # "GG=4,GMA=1" -> (["GG", "GMA"], [4, 1])
+    commands, weights = [], []
+    for item in mix.split(','):
+        command, _, weight = item.partition('=')
+        commands.append(command)
+        weights.append(float(weight) if weight else 1.0)
+    return commands, weights
+
+async def run_connection(host, port, protocol, student_ids, commands, weights,
+                         batch, deadline, seed):
+    # Send requests back to back on one connection until the deadline.
+    # Returns the list of request latencies (seconds) and error count.
+    rng = random.Random(seed)
+    latencies = []
+    errors = 0
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        while time.monotonic() < deadline:
+            student_id = rng.choice(student_ids)
+            command_ids = rng.choices(commands, weights, k=batch)
+            start_time = time.perf_counter()
+            if protocol == "framed":
+                request = "{},{}".format(student_id, BATCH_SEPARATOR.join(command_ids))
+                payload = request.encode(MSG_ENCODING)
+                writer.write(len(payload).to_bytes(FRAME_LENGTH_FIELD_LEN, byteorder='big')
+                             + payload)
+                length_field = await reader.readexactly(FRAME_LENGTH_FIELD_LEN)
+                response = await reader.readexactly(int.from_bytes(length_field, byteorder='big'))
+            else:
+                request = "{},{}".format(student_id, command_ids[0])
+                writer.write(request.encode(MSG_ENCODING))
+                response = await reader.read(RECV_BUFFER_SIZE)
+                if len(response) == 0:
+                    raise ConnectionError("Server closed the connection")
+            latencies.append(time.perf_counter() - start_time)
+            if response == b'0':
+                errors += 1
+    finally:
+        writer.close()
+    return latencies, errors
+
+async def run_connections(host, port, protocol, student_ids, commands, weights,
+                          batch, duration, connections, seed):
+    deadline = time.monotonic() + duration
+    results = await asyncio.gather(*[
+        run_connection(host, port, protocol, student_ids, commands, weights,
+                       batch, deadline, seed + i)
+        for i in range(connections)], return_exceptions=True)
+    latencies = []
+    errors = 0
+    failed_connections = 0
+    for result in results:
+        if isinstance(result, BaseException):
+            failed_connections += 1
+            continue
+        latencies.extend(result[0])
+        errors += result[1]
+    return latencies, errors, failed_connections
+
+def load_worker(args):
+    # Entry point for each load generating process.
+    return asyncio.run(run_connections(*args))
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def run_benchmark(args, student_ids):
+    commands, weights = parse_mix(args.mix)
+
+    # Spread the connections over the load generating processes so
+    # that the client side does not become the bottleneck.
+    processes = max(1, min(args.client_processes, args.concurrency))
+    work = []
+    for i in range(processes):
+        connections = args.concurrency // processes + (1 if i < args.concurrency % processes else 0)
+        work.append((args.host, args.port, args.protocol, student_ids, commands, weights,
+                     args.batch, args.duration, connections, args.seed + 1000 * i))
+
+    start_time = time.perf_counter()
+    if processes == 1:
+        results = [load_worker(work[0])]
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(load_worker, work)
+    elapsed = time.perf_counter() - start_time
+
+    latencies = sorted(latency for result in results for latency in result[0])
+    errors = sum(result[1] for result in results)
+    failed_connections = sum(result[2] for result in results)
+
+    def ms(value):
+        return None if value is None else round(value * 1000, 3)
+
+    return {
+        "server_mode": args.server_mode,
+        "server_processes": args.server_processes,
+        "shards": args.shards,
+        "protocol": args.protocol,
+        "roster_size": len(student_ids),
+        "concurrency": args.concurrency,
+        "client_processes": processes,
+        "mix": args.mix,
+        "batch": args.batch,
+        "duration_s": round(elapsed, 3),
+        "requests": len(latencies),
+        "errors": errors,
+        "failed_connections": failed_connections,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else None,
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "max": ms(latencies[-1]) if latencies else None,
+        },
+    }
+
+########################################################################
+# Process command line arguments if this module is run directly.
+########################################################################
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Grade server load benchmark")
+
+    parser.add_argument('--server-mode', default="asyncio",
+                        choices=("serial", "asyncio"),
+                        help='serving mode of the server that is started')
+    parser.add_argument('--server-processes', default=1, type=int,
+                        help='worker processes of the server that is started')
+    parser.add_argument('--shards', default=0, type=int,
+                        help='start this many shard servers behind a router')
+    parser.add_argument('--no-server', action='store_true',
+                        help='benchmark an already running server')
+    parser.add_argument('--host', default="127.0.0.1", type=str)
+    parser.add_argument('--port', default=50100, type=int)
+    parser.add_argument('--grades-file', default=None, type=str,
+                        help='roster to serve (default: a synthetic roster)')
+    parser.add_argument('--roster-size', default=1000, type=int,
+                        help='number of students in the synthetic roster')
+    parser.add_argument('--protocol', default="legacy", choices=("legacy", "framed"))
+    parser.add_argument('--mix', default="GG=1,GMA=1,GEA=1", type=str,
+                        help='weighted command mix, e.g. GG=4,GMA=1')
+    parser.add_argument('--batch', default=1, type=int,
+                        help='commands per framed request')
+    parser.add_argument('--concurrency', default=10, type=int,
+                        help='number of simultaneous client connections')
+    parser.add_argument('--client-processes', default=1, type=int,
+                        help='load generating processes')
+    parser.add_argument('--duration', default=10.0, type=float,
+                        help='seconds to generate load')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--output', default=None, type=str,
+                        help='write the JSON report to this file')
+
+    args = parser.parse_args()
+    if args.shards > 0 and args.server_processes > 1:
+        parser.error("shard servers run as a single process, so --shards "
+                     "cannot be combined with --server-processes")
+    if args.protocol == "legacy":
+        args.batch = 1
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.grades_file is None:
+            args.grades_file = os.path.join(tmpdir, "synthetic_grades.csv")
+            student_ids = write_synthetic_roster(args.grades_file, args.roster_size, args.seed)
+        else:
+            args.grades_file = os.path.abspath(args.grades_file)
+            if args.shards > 0 and is_binary_roster(args.grades_file):
+                parser.error("compiled rosters cannot be sharded")
+            student_ids = read_roster_ids(args.grades_file)
+
+        servers = []
+        if args.no_server:
+            pass
+        elif args.shards > 0:
+            servers = start_sharded_servers(args.server_mode, args.port, args.grades_file,
+                                            args.shards)
+        else:
+            servers = [start_server(args.server_mode, args.port, args.grades_file,
+                                    args.server_processes)]
+        try:
+            report = run_benchmark(args, student_ids)
+        finally:
+            for server in servers:
+                stop_server(server)
+
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(report_json + "\n")
+    print(report_json)
+
+########################################################################
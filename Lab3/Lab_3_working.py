@@ -7,6 +7,7 @@ import argparse
 import sys, errno
 import threading
 import os
+import time
 
 ########################################################################
 
@@ -15,49 +16,140 @@ import os
 CMD_FIELD_LEN            = 1 # 1 byte commands sent from the client.
 FILENAME_SIZE_FIELD_LEN  = 1 # 1 byte file name size field.
 FILESIZE_FIELD_LEN       = 8 # 8 byte file size field.
+OFFSET_FIELD_LEN         = 8 # 8 byte RGET range offset field.
+LENGTH_FIELD_LEN         = 8 # 8 byte RGET range length field.
     
 # Define a dictionary of commands. The actual command field value must
 # be a 1-byte integer. For now, we only define the "GET" command,
 # which tells the server to send a file.
+#
+# "RGET" asks for part of a file: the filename is followed by offset
+# and length fields, a length of 0 meaning up to the end of the file.
+# The server replies with the size of the whole file, then the length
+# of the range it sends (cut short at the end of the file) and the
+# range itself.
 
-CMD = {"GET" : 1, "PUT" : 2, "LIST" : 3, "BYE" : 4}
+CMD = {"GET" : 1, "PUT" : 2, "LIST" : 3, "BYE" : 4, "RGET" : 5}
 
 MSG_ENCODING = "utf-8"
 SOCKET_TIMEOUT = 4
 
+# Largest buffer that recv_bytes allocates before the data arrives.
+RECV_PREALLOCATE_MAX = 1 << 24
+
+# Files are transferred as raw bytes, exactly as they are on disk, and
+# are moved between the socket and the file CHUNK_SIZE bytes at a time
+# (set with --chunk-size).
+CHUNK_SIZE = 1 << 16
+
 ########################################################################
 # recv_bytes frontend to recv
 ########################################################################
 
 # Call recv to read bytecount_target bytes from the socket. Return a
-# status (True or False) and the received butes (in the former case).
+# status (True or False) and the received bytes (in the former case).
 def recv_bytes(sock, bytecount_target):
     # Be sure to timeout the socket if we are given the wrong
     # information.
-    print(bytecount_target)
     sock.settimeout(SOCKET_TIMEOUT)
     try:
+        # Receive straight into one buffer, so the data is copied once
+        # no matter how many recv calls it takes. The size comes from
+        # the other end, so no more than RECV_PREALLOCATE_MAX bytes are
+        # allocated up front; past that the buffer grows as the data
+        # actually arrives.
+        recv_bytes = bytearray(min(bytecount_target, RECV_PREALLOCATE_MAX)) # complete received message
+        recv_view = memoryview(recv_bytes)
         byte_recv_count = 0 # total received bytes
-        recv_bytes = b''    # complete received message
         while byte_recv_count < bytecount_target:
-            # Ask the socket for the remaining byte count.
-            new_bytes = sock.recv(bytecount_target-byte_recv_count)
+            if byte_recv_count == len(recv_bytes):
+                recv_view.release()
+                recv_bytes += bytes(min(len(recv_bytes), bytecount_target - len(recv_bytes)))
+                recv_view = memoryview(recv_bytes)
+            # Fill in the rest of the buffer.
+            new_byte_count = sock.recv_into(recv_view[byte_recv_count:])
             # If ever the other end closes on us before we are done,
             # give up and return a False status with zero bytes.
-            if not new_bytes:
+            if new_byte_count == 0:
                 return(False, b'')
-            byte_recv_count += len(new_bytes)
-            recv_bytes += new_bytes
-        # Turn off the socket timeout if we finish correctly.
-        sock.settimeout(None)            
+            byte_recv_count += new_byte_count
+        recv_view.release()
         return (True, recv_bytes)
     # If the socket times out, something went wrong. Return a False
     # status.
     except socket.timeout:
-        sock.settimeout(None)        
         print("recv_bytes: Recv socket timeout!")
         return (False, b'')
+    except MemoryError:
+        print("recv_bytes: Out of memory!")
+        return (False, b'')
+    finally:
+        # Turn off the socket timeout whether or not we finished.
+        sock.settimeout(None)
     
+########################################################################
+# recv_file frontend to recv
+########################################################################
+
+# Receive count bytes from the socket and write them to an open binary
+# file, CHUNK_SIZE bytes at a time through one reused buffer, so the
+# memory used does not depend on the file size. Return a status (True
+# or False) like recv_bytes.
+def recv_file(sock, file, count):
+    sock.settimeout(SOCKET_TIMEOUT)
+    try:
+        buffer = bytearray(CHUNK_SIZE)
+        buffer_view = memoryview(buffer)
+        byte_recv_count = 0 # total received bytes
+        while byte_recv_count < count:
+            new_byte_count = sock.recv_into(buffer_view[:min(CHUNK_SIZE, count - byte_recv_count)])
+            # If ever the other end closes on us before we are done,
+            # give up and return a False status.
+            if new_byte_count == 0:
+                return False
+            file.write(buffer_view[:new_byte_count])
+            byte_recv_count += new_byte_count
+        return True
+    except socket.timeout:
+        print("recv_file: Recv socket timeout!")
+        return False
+    finally:
+        sock.settimeout(None)
+
+# Output the size and throughput of a finished transfer.
+def print_transfer(action, filename, byte_count, start_time):
+    elapsed = time.perf_counter() - start_time
+    rate = byte_count / elapsed / 1e6 if elapsed > 0 else float('inf')
+    print("{} {}: {} bytes in {:.3f} s ({:.1f} MB/s)".format(action, filename, byte_count, elapsed, rate))
+
+########################################################################
+# send_file frontend to sendfile
+########################################################################
+
+# Send count bytes from an open binary file over the socket, starting
+# offset bytes into it. Where the platform has os.sendfile,
+# socket.sendfile has the kernel copy the file pages straight to the
+# socket. Otherwise the file is read into one reused buffer and sent
+# CHUNK_SIZE bytes at a time. Either way the memory used does not
+# depend on the file size. Returns the number of bytes sent.
+def send_file(sock, file, count, offset=0):
+    # socket.sendfile takes a count of 0 to mean the whole file.
+    if count == 0:
+        return 0
+    if hasattr(os, "sendfile"):
+        return sock.sendfile(file, offset, count)
+    file.seek(offset)
+    buffer = bytearray(CHUNK_SIZE)
+    buffer_view = memoryview(buffer)
+    byte_sent_count = 0
+    while byte_sent_count < count:
+        new_byte_count = file.readinto(buffer_view[:min(CHUNK_SIZE, count - byte_sent_count)])
+        if not new_byte_count:
+            break
+        sock.sendall(buffer_view[:new_byte_count])
+        byte_sent_count += new_byte_count
+    return byte_sent_count
+
 ########################################################################
 # Service Discovery Server
 #
@@ -96,6 +188,10 @@ class Server:
 
     SERVER_DIR = "./serverDirectory/"
 
+    # Uploads in progress are written to ".<filename>.<thread><suffix>"
+    # and left out of directory listings.
+    PARTIAL_SUFFIX = ".part"
+
     def __init__(self):
         self.showDir()        
         self.get_service_discovery_socket()
@@ -206,6 +302,13 @@ class Server:
                     print("Closing {} client connection ... ".format(address_port))           
                     connection.close()
                     break
+            if cmd == CMD["RGET"]:
+                print("Server: Recieved RGET CMD")
+                error = self.getFile(client, ranged=True)
+                if(error == 'close'):
+                    print("Closing {} client connection ... ".format(address_port))           
+                    connection.close()
+                    break
             if cmd == CMD["PUT"]:
                 print("Server: Recieved PUT CMD")
                 error = self.putFile(client)
@@ -215,8 +318,12 @@ class Server:
                     break
 
 
+    def list_server_dir(self):
+        return [item for item in os.listdir(Server.SERVER_DIR)
+                if not item.endswith(Server.PARTIAL_SUFFIX)]
+
     def showDir(self):
-        server_list = os.listdir(Server.SERVER_DIR)
+        server_list = self.list_server_dir()
         list_item = ""
         for item in server_list:
             list_item += item + "\n"
@@ -224,7 +331,7 @@ class Server:
 
     def rlist(self,client):
         connection, address = client
-        server_list = os.listdir(Server.SERVER_DIR)
+        server_list = self.list_server_dir()
         list_item = ""
         for item in server_list:
             list_item += item + "\n"
@@ -234,7 +341,8 @@ class Server:
         list_sizeBytes = list_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
         connection.sendall(list_sizeBytes + list_item)
 
-    def getFile(self, client):
+    # Serve a GET, or an RGET when ranged is set.
+    def getFile(self, client, ranged=False):
         connection, address = client
 
         status, filename_size_field = recv_bytes(connection, FILENAME_SIZE_FIELD_LEN)
@@ -257,37 +365,64 @@ class Server:
         filename = filename_bytes.decode(MSG_ENCODING)
         print('Requested filename = ', filename)
 
+        if ranged:
+            status, range_fields = recv_bytes(connection, OFFSET_FIELD_LEN + LENGTH_FIELD_LEN)
+            if not status:
+                return 'close'
+            offset = int.from_bytes(range_fields[:OFFSET_FIELD_LEN], byteorder='big')
+            length = int.from_bytes(range_fields[OFFSET_FIELD_LEN:], byteorder='big')
+            print('Requested range = ', offset, length)
+
         ################################################################
         # See if we can open the requested file. If so, send it.
         
         # If we can't find the requested file, shutdown the connection
         # and wait for someone else.
         try:
-            file = open(Client.SERVER_DIR + '/' + filename, 'r').read()
+            file = open(Server.SERVER_DIR + '/' + filename, 'rb')
         except FileNotFoundError:
             print(Server.FILE_NOT_FOUND_MSG)
             connection.close()          
             return 'close'
 
-        # Encode the file contents into bytes, record its size and
-        # generate the file size field used for transmission.
-        file_bytes = file.encode(MSG_ENCODING)
-        file_size_bytes = len(file_bytes)
-        file_size_field = file_size_bytes.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+        # The file is sent as it is on disk, straight from the file,
+        # so it is never held in memory. Record its size and generate
+        # the file size field used for transmission.
+        with file:
+            file_size_bytes = os.fstat(file.fileno()).st_size
+            file_size_field = file_size_bytes.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+
+            # A range is cut short at the end of the file, and is
+            # empty if it starts past the end.
+            if ranged:
+                offset = min(offset, file_size_bytes)
+                send_count = file_size_bytes - offset
+                if length:
+                    send_count = min(send_count, length)
+                header = file_size_field + send_count.to_bytes(LENGTH_FIELD_LEN, byteorder='big')
+            else:
+                offset = 0
+                send_count = file_size_bytes
+                header = file_size_field
 
-        # Create the packet to be sent with the header field.
-        pkt = file_size_field + file_bytes
-        
-        try:
-            # Send the packet to the connected client.
-            connection.sendall(pkt)
-            print("Sending file: ", filename)
-            print("file size field: ", file_size_field.hex(), "\n")
-            # time.sleep(20)
-        except socket.error:
-            # If the client has closed the connection, close the
-            # socket on this end.
-            print("Closing client connection ...")
+            try:
+                # Send the header fields, then the file.
+                print("Sending file: ", filename)
+                print("header fields: ", header.hex(), "\n")
+                start_time = time.perf_counter()
+                connection.sendall(header)
+                byte_sent_count = send_file(connection, file, send_count, offset)
+                print_transfer("Sent", filename, byte_sent_count, start_time)
+            except socket.error:
+                # If the client has closed the connection, close the
+                # socket on this end.
+                print("Closing client connection ...")
+                return 'close'
+
+        if byte_sent_count < send_count:
+            # The file shrank while it was being sent, so the client
+            # would wait for bytes that never come.
+            print("File changed while sending, closing client connection ...")
             return 'close'
 
     def putFile(self, client):
@@ -324,29 +459,48 @@ class Server:
         file_size = int.from_bytes(file_size_bytes, byteorder='big')
         print("File size = ", file_size)
 
-        # self.socket.settimeout(4)                                  
-        status, recvd_bytes_total = recv_bytes(connection, file_size)
-        if not status:
-            print("Closing connection ...")            
-            connection.close()
-            return
+        # Only plain names are accepted, so an upload cannot land
+        # outside of the server directory.
+        if filename != os.path.basename(filename) or filename in ('.', '..') \
+           or filename.endswith(Server.PARTIAL_SUFFIX):
+            print("Invalid filename, closing connection ...")
+            return 'close'
 
-        # Receive the file itself.
+        # Receive the file itself into a temporary file in the same
+        # directory, then rename it over the target. The rename is
+        # atomic, so a concurrent GET sees either the old file or the
+        # complete new one, never a partly written one.
+        filepath = Server.SERVER_DIR + '/' + filename
+        tmp_filepath = "{}/.{}.{}{}".format(Server.SERVER_DIR, filename,
+                                            threading.get_ident(), Server.PARTIAL_SUFFIX)
         try:
-            # Create a file using the received filename and store the
-            # data.
-            print("Received {} bytes. Creating file: {}" \
-                  .format(len(recvd_bytes_total), filename))
-
-            with open(f'serverDirectory/{filename}', 'w') as f:
-                recvd_file = recvd_bytes_total.decode(MSG_ENCODING)
-                f.write(recvd_file)
-            print(recvd_file)
+            start_time = time.perf_counter()
+            with open(tmp_filepath, 'wb') as f:
+                # Reserve the disk space up front: a full disk is found
+                # before anything is received, and the file is not
+                # fragmented by growing a chunk at a time.
+                if file_size > 0 and hasattr(os, "posix_fallocate"):
+                    try:
+                        os.posix_fallocate(f.fileno(), 0, file_size)
+                    except OSError as e:
+                        if e.errno == errno.ENOSPC:
+                            raise
+                status = recv_file(connection, f, file_size)
+            if not status:
+                print("Closing connection ...")            
+                return 'close'
+            os.replace(tmp_filepath, filepath)
+            print_transfer("Received", filename, file_size, start_time)
         except KeyboardInterrupt:
             print()
             exit(1)
-        except IOError:
-            print("Could not download file.")
+        except IOError as e:
+            print("Could not download file: {}".format(e))
+            return 'close'
+        finally:
+            # Nothing is left behind if the upload did not complete.
+            if os.path.exists(tmp_filepath):
+                os.remove(tmp_filepath)
 
 ########################################################################
 # Service Discovery Client
@@ -419,7 +573,7 @@ class Client:
             while True:
                 # We are connected to the FS. Prompt the user for what to
                 # do.
-                client_prompt_input = input("Please enter one of the following commands (scan, connect <IP address> <port>, llist, rlist, put <filename>, get <filename>, bye: ")
+                client_prompt_input = input("Please enter one of the following commands (scan, connect <IP address> <port>, llist, rlist, put <filename>, get <filename> [--resume], bye: ")
                 if client_prompt_input:
                 # If the user enters something, process it.
                     try:
@@ -474,10 +628,14 @@ class Client:
                                 exit()
                     elif client_prompt_cmd =='get':
                         try:
-                            if(len(client_prompt_args)==1):
-                                self.get_file(client_prompt_args[0])
+                            # --resume fetches only what is missing
+                            # from the copy in the client directory.
+                            resume = '--resume' in client_prompt_args
+                            get_args = [arg for arg in client_prompt_args if arg != '--resume']
+                            if(len(get_args)==1):
+                                self.get_file(get_args[0], resume)
                             else:
-                                self.get_file()
+                                self.get_file(resume=resume)
                         except IOError as e: 
                             if e.errno == errno.EPIPE:
                                 print("No connection to server")
@@ -557,12 +715,19 @@ class Client:
         list = self.fs_socket.recv(list_size).decode(MSG_ENCODING)
         print(list)
 
-    def get_file(self, filename=Server.REMOTE_FILE_NAME):
+    # With resume set, an existing copy in the client directory is kept
+    # and only the rest of the file is requested, using RGET.
+    def get_file(self, filename=Server.REMOTE_FILE_NAME, resume=False):
+        filepath = Client.CLIENT_DIR + '/' + filename
+        offset = 0
+        if resume and os.path.exists(filepath):
+            offset = os.path.getsize(filepath)
+
         ################################################################
         # Generate a file transfer request to the server
         
         # Create the packet cmd field.
-        cmd_field = CMD["GET"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+        cmd_field = CMD["RGET" if resume else "GET"].to_bytes(CMD_FIELD_LEN, byteorder='big')
 
         # Create the packet filename field.
         filename_field_bytes = filename.encode(MSG_ENCODING)
@@ -577,6 +742,12 @@ class Client:
         
         pkt = cmd_field + filename_size_field + filename_field_bytes
 
+        # Ask for everything from the end of the local copy on.
+        if resume:
+            pkt += offset.to_bytes(OFFSET_FIELD_LEN, byteorder='big') \
+                   + (0).to_bytes(LENGTH_FIELD_LEN, byteorder='big')
+            print("Offset field: ", offset)
+
         # Send the request packet to the server.
         self.fs_socket.sendall(pkt)
 
@@ -599,24 +770,40 @@ class Client:
         file_size = int.from_bytes(file_size_bytes, byteorder='big')
         print("File size = ", file_size)
 
-        #self.socket.settimeout(4)                                  
-        status, recvd_bytes_total = recv_bytes(self.fs_socket, file_size)
-        if not status:
-            print("Closing connection ...")            
-            self.fs_socket.close()
-            return
-        # print("recvd_bytes_total = ", recvd_bytes_total)
-        # Receive the file itself.
+        # An RGET reply also says how much of the file follows.
+        recv_count = file_size
+        if resume:
+            status, length_bytes = recv_bytes(self.fs_socket, LENGTH_FIELD_LEN)
+            if not status:
+                print("Closing connection ...")
+                self.fs_socket.close()
+                return
+            recv_count = int.from_bytes(length_bytes, byteorder='big')
+            print("Range size = ", recv_count)
+
+            if offset > file_size:
+                # The local copy is not a prefix of the remote file, so
+                # fetch the whole file again.
+                print("Local file is larger than the remote file, getting all of it ...")
+                return self.get_file(filename)
+            if recv_count == 0:
+                print("{} is already complete".format(filename))
+                return
+
+        # Receive the file itself, straight into the file. Whatever has
+        # arrived stays on disk if the transfer is cut off, so that it
+        # can be resumed later.
         try:
             # Create a file using the received filename and store the
-            # data.
-            print("Received {} bytes. Creating file: {}" \
-                  .format(len(recvd_bytes_total), filename))
-
-            with open(Client.CLIENT_DIR + '/' + filename, 'w') as f:
-                recvd_file = recvd_bytes_total.decode(MSG_ENCODING)
-                f.write(recvd_file)
-            print(recvd_file)
+            # data, or add to the end of the local copy when resuming.
+            start_time = time.perf_counter()
+            with open(filepath, 'ab' if resume else 'wb') as f:
+                status = recv_file(self.fs_socket, f, recv_count)
+            if not status:
+                print("Closing connection ...")            
+                self.fs_socket.close()
+                return
+            print_transfer("Received", filename, recv_count, start_time)
         except KeyboardInterrupt:
             print()
             exit(1)
@@ -626,36 +813,41 @@ class Client:
         ################################################################
         # Generate a file transfer request to the server
         try:
-            file = open(Client.CLIENT_DIR + '/' + filename, 'r').read()
+            file = open(Client.CLIENT_DIR + '/' + filename, 'rb')
         except FileNotFoundError:
             print("Client: requested file is not found! Closing connection")
             self.fs_socket.close()
             return 
 
-        cmd_field = CMD["PUT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
-        filename_field_bytes = filename.encode(MSG_ENCODING)
-        filename_size_field = len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
-        # Encode the file contents into bytes, record its size and
-        # generate the file size field used for transmission.
-        file_bytes = file.encode(MSG_ENCODING)
-        file_size_field = len(file_bytes).to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
+        with file:
+            cmd_field = CMD["PUT"].to_bytes(CMD_FIELD_LEN, byteorder='big')
+            filename_field_bytes = filename.encode(MSG_ENCODING)
+            filename_size_field = len(filename_field_bytes).to_bytes(FILENAME_SIZE_FIELD_LEN, byteorder='big')
+            # Record the file size and generate the file size field
+            # used for transmission. The file is sent as it is on disk.
+            file_size = os.fstat(file.fileno()).st_size
+            file_size_field = file_size.to_bytes(FILESIZE_FIELD_LEN, byteorder='big')
 
-        # Create the packet.
-        pkt = cmd_field + filename_size_field + filename_field_bytes + file_size_field + file_bytes
+            # Create the packet header.
+            pkt = cmd_field + filename_size_field + filename_field_bytes + file_size_field
 
-        # Send the request packet to the server.
-        try:
+            # Send the request packet header to the server, then the
+            # file.
+            try:
 
-            print("CMD field: ", cmd_field.hex())
-            print("Filename_size_field: ", filename_size_field.hex())
-            print("Filename field: ", filename_field_bytes.hex())
-            print("File_size field: ", file_size_field.hex())
-            self.fs_socket.sendall(pkt)
+                print("CMD field: ", cmd_field.hex())
+                print("Filename_size_field: ", filename_size_field.hex())
+                print("Filename field: ", filename_field_bytes.hex())
+                print("File_size field: ", file_size_field.hex())
+                start_time = time.perf_counter()
+                self.fs_socket.sendall(pkt)
+                byte_sent_count = send_file(self.fs_socket, file, file_size)
+                print_transfer("Sent", filename, byte_sent_count, start_time)
 
-        except socket.error:
-            print("Encountered send error, closing client connection...")
-            self.fs_socket.close()
-            return
+            except socket.error:
+                print("Encountered send error, closing client connection...")
+                self.fs_socket.close()
+                return
 
 ########################################################################
 # Fire up a client/server if run directly.
@@ -670,7 +862,15 @@ if __name__ == '__main__':
                         help='client or server role',
                         required=True, type=str)
 
+    parser.add_argument('-c', '--chunk-size',
+                        default=CHUNK_SIZE,
+                        help='bytes moved per read/write during file transfers',
+                        type=int)
+
     args = parser.parse_args()
+    if args.chunk_size < 1:
+        parser.error("--chunk-size must be at least 1")
+    CHUNK_SIZE = args.chunk_size
     roles[args.role]()
                 
 
@@ -51,37 +51,53 @@ CMD = {"GET" : 2}
 MSG_ENCODING = "utf-8"
 SOCKET_TIMEOUT = 4
 
+# Largest buffer that recv_bytes allocates before the data arrives.
+RECV_PREALLOCATE_MAX = 1 << 24
+
 ########################################################################
 # recv_bytes frontend to recv
 ########################################################################
 
 # Call recv to read bytecount_target bytes from the socket. Return a
-# status (True or False) and the received butes (in the former case).
+# status (True or False) and the received bytes (in the former case).
 def recv_bytes(sock, bytecount_target):
     # Be sure to timeout the socket if we are given the wrong
     # information.
     sock.settimeout(SOCKET_TIMEOUT)
     try:
+        # Receive straight into one buffer, so the data is copied once
+        # no matter how many recv calls it takes. The size comes from
+        # the other end, so no more than RECV_PREALLOCATE_MAX bytes are
+        # allocated up front; past that the buffer grows as the data
+        # actually arrives.
+        recv_bytes = bytearray(min(bytecount_target, RECV_PREALLOCATE_MAX)) # complete received message
+        recv_view = memoryview(recv_bytes)
         byte_recv_count = 0 # total received bytes
-        recv_bytes = b''    # complete received message
         while byte_recv_count < bytecount_target:
-            # Ask the socket for the remaining byte count.
-            new_bytes = sock.recv(bytecount_target-byte_recv_count)
+            if byte_recv_count == len(recv_bytes):
+                recv_view.release()
+                recv_bytes += bytes(min(len(recv_bytes), bytecount_target - len(recv_bytes)))
+                recv_view = memoryview(recv_bytes)
+            # Fill in the rest of the buffer.
+            new_byte_count = sock.recv_into(recv_view[byte_recv_count:])
             # If ever the other end closes on us before we are done,
             # give up and return a False status with zero bytes.
-            if not new_bytes:
+            if new_byte_count == 0:
                 return(False, b'')
-            byte_recv_count += len(new_bytes)
-            recv_bytes += new_bytes
-        # Turn off the socket timeout if we finish correctly.
-        sock.settimeout(None)            
+            byte_recv_count += new_byte_count
+        recv_view.release()
         return (True, recv_bytes)
     # If the socket times out, something went wrong. Return a False
     # status.
     except socket.timeout:
-        sock.settimeout(None)        
         print("recv_bytes: Recv socket timeout!")
         return (False, b'')
+    except MemoryError:
+        print("recv_bytes: Out of memory!")
+        return (False, b'')
+    finally:
+        # Turn off the socket timeout whether or not we finished.
+        sock.settimeout(None)
 
 ########################################################################
 # SERVER